@@ -3,6 +3,9 @@
 """
 Основной модуль бота.
 """
+import concurrent.futures
+import functools
+import html
 import io
 import logging
 import os
@@ -13,6 +16,7 @@ import signal
 import string
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import typing
@@ -34,10 +38,18 @@ try:
     from .external_api import whatanime_ga
     from .external_api import iqdb_org
     from .tgdata.inline_sound import InlineSound
+    from .utils.single_flight import SingleFlight
+    from .utils import download, result_cache, image_hash, image_pool, http_session, quota, circuit_breaker, \
+        sampler_pool, sample_buffer, admission, prefetch, \
+        anek_corpus
 except ImportError:
     from tgdata import chat_state, vk_group
     from tgdata.inline_sound import InlineSound
     from external_api import whatanime_ga, iqdb_org
+    from utils.single_flight import SingleFlight
+    from utils import download, result_cache, image_hash, image_pool, http_session, quota, circuit_breaker, \
+        sampler_pool, sample_buffer, admission, prefetch, \
+        anek_corpus
     import config
 
 users_dict: typing.Dict[str, int] = {}
@@ -72,21 +84,182 @@ saves_path = os.path.join(config.BOT_HOME, "saves")
 tmp_path = os.path.join(config.BOT_HOME, "tmp")
 
 bot = telebot.TeleBot(config.BOT_TOKEN, num_threads=int(config.NUM_THREADS))
+images: image_pool.ImagePool = None
+media_executor = concurrent.futures.ThreadPoolExecutor(int(config.NUM_THREADS), thread_name_prefix="media")
+"""
+Потоки для фоновой отправки медиа (превью whatanime).
+"""
+search_executor = concurrent.futures.ThreadPoolExecutor(int(config.NUM_THREADS), thread_name_prefix="search")
+"""
+Потоки для параллельных запросов к поисковикам (``/sauce``).
+"""
+
+
+def make_http_session() -> http_session.TimeoutSession:
+    """
+    Создает HTTP-сессию для одного внешнего сервиса: пул по числу потоков, таймауты и прокси из конфига.
+
+    :return: готовая сессия
+    :rtype: http_session.TimeoutSession
+    """
+    return http_session.make_session(int(config.NUM_THREADS),
+                                     (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT), config.PROXY)
+
+
+quote_session = make_http_session()
+anek_session = make_http_session()
+
+
+def make_breaker(name: str) -> circuit_breaker.CircuitBreaker:
+    """
+    Создает предохранитель внешнего сервиса с настройками из конфига.
+    Плохой ввод пользователя и сбои пула картинок не считаются ошибкой сервиса.
+
+    :param str name: название сервиса
+    :return: предохранитель
+    :rtype: circuit_breaker.CircuitBreaker
+    """
+    return circuit_breaker.CircuitBreaker(name, failure_rate=config.BREAKER_FAILURE_RATE,
+                                          slow_call=config.BREAKER_SLOW_CALL,
+                                          open_seconds=config.BREAKER_OPEN_SECONDS,
+                                          excluded=(image_pool.NotAPictureError, image_pool.PoolBusyError,
+                                                    image_pool.PoolTimeoutError, image_pool.BrokenProcessPool))
+
+
+breakers: typing.Dict[str, circuit_breaker.CircuitBreaker] = {
+    "iqdb": make_breaker("iqdb.org"),
+    "whatanime": make_breaker("trace.moe"),
+    "quote": make_breaker("tproger.ru"),
+    "anek": make_breaker("baneks.ru"),
+    "vk": make_breaker("vk.com"),
+}
+"""
+Предохранители внешних сервисов.
+ключ <-> CircuitBreaker
+"""
+
+
+def fetch_quote() -> str:
+    """
+    Загружает случайную цитату с `tproger.ru`.
+
+    :return: цитата
+    :rtype: str
+    """
+    def get_quote() -> str:
+        response = quote_session.get("https://tproger.ru/wp-content/plugins/citation-widget/get-quote.php")
+        response.raise_for_status()  # Ошибка сервера -- ошибка для предохранителя
+        return response.text
+
+    return breakers["quote"].call(get_quote)
+
+
+def fetch_anek(anek_id: int) -> typing.Optional[str]:
+    """
+    Загружает анекдот с `baneks.ru` по номеру.
+
+    :param int anek_id: номер анекдота
+    :return: анекдот или ``None``, если такого нет
+    :rtype: typing.Optional[str]
+    """
+    def get_anek() -> typing.Optional[requests.Response]:
+        response = anek_session.get(f"https://baneks.ru/{anek_id}")
+        if response.status_code == 404:
+            return None  # Пустой номер -- не ошибка сервиса
+        response.raise_for_status()
+        return response
+
+    request = breakers["anek"].call(get_anek)
+    if request is None:
+        return None
+    request.encoding = "utf-8"
+    # Да, это парсинг регексами: сервер отдает данные без экранирования кавычек...
+    result = HTML_ANEK_REGEX.search(request.text)
+    return result.group(1) if result else None
+
+
+def fetch_random_anek(attempts: int = 3) -> typing.Optional[str]:
+    """
+    Загружает случайный анекдот прямо с `baneks.ru`, пока локальная база пуста, и сохраняет его в базу.
+
+    :param int attempts: сколько номеров попробовать, если страницы окажутся пустыми
+    :return: анекдот или ``None``, если все попытки попали на пустые страницы
+    :rtype: typing.Optional[str]
+    :raise circuit_breaker.CircuitOpenError: сайт отключен предохранителем
+    """
+    for _ in range(attempts):
+        anek_id = random.randint(1, max(aneks.max_id, 1))
+        anek = fetch_anek(anek_id)
+        aneks.add(anek_id, anek)
+        if anek is not None:
+            return anek
+    return None
+
+
+quotes = prefetch.Prefetcher("tproger.ru", fetch_quote, config.PREFETCH_SIZE, config.PREFETCH_RECENT)
+aneks: anek_corpus.AnekCorpus = None
+
+gatekeeper = admission.Admission(config.USER_RATE, config.USER_BURST, config.CHAT_RATE, config.CHAT_BURST)
+"""
+Допуск тяжелых команд: они выполняются в своих пулах, а не в потоках TeleBot.
+"""
+gatekeeper.add_class("neuroshit", config.NEURO_WORKERS, config.COMMAND_QUEUE, config.COMMAND_QUEUE_PER_CHAT)
+# whatanime.ga ждет своей квоты до WHATANIME_MAX_WAIT: в общем классе он занимал бы потоки поиска iqdb.org
+for command_class in ("search", "whatanime", "vk", "anek"):
+    gatekeeper.add_class(command_class, config.COMMAND_WORKERS, config.COMMAND_QUEUE, config.COMMAND_QUEUE_PER_CHAT)
 iqdb: iqdb_org.IqdbClient = None
 iqdb_disabled = True
 whatanime: whatanime_ga.WhatAnimeClient = None
 whatanime_disabled = True
+whatanime_quota: quota.QuotaScheduler = None
+photo_savings: typing.Dict[str, typing.List[int]] = {}
+"""
+Экономия трафика за счет выбора меньшего размера фото.
+движок <-> [скачано байт, байт в самых больших размерах]
+"""
+search_cache = result_cache.ResultCache(os.path.join(saves_path, "search_cache.pkl"),
+                                        config.SEARCH_CACHE_TTL, config.SEARCH_CACHE_SIZE,
+                                        config.SEARCH_CACHE_EMPTY_TTL)
+"""
+Кэш результатов поиска.
+(движок, ``file_unique_id`` или хеш картинки) <-> список результатов
+"""
 vk: VkApiMethod = None
 vk_tools: VkTools = None
 vk_disabled = True
+vk_wall_flight = SingleFlight()
+"""
+Объединяет одновременные загрузки стены одной и той же группы ВК.
+vk_group.vk_id <-> ответ ``wall.get``
+"""
+
+media_groups: typing.Dict[typing.Tuple[int, str], typing.List[Message]] = {}
+"""
+Собираемые альбомы для пакетного поиска.
+(msg.chat.id, msg.media_group_id) <-> сообщения альбома
+"""
+media_group_timers: typing.Dict[typing.Tuple[int, str], threading.Timer] = {}
+media_groups_lock = threading.Lock()
 
 neuroshit_disabled = True
+neuro_pool: sampler_pool.SamplerPool = None
+neuro_buffer: sample_buffer.SampleBuffer = None
 
 VK_VER = 5.69
 
 VK_PHOTO_ATTACH_REGEX = re.compile(r"photo_(\d+)")
 VK_GROUP_REGEX = re.compile(r".*vk\.com/(.+?)(\?.+)?$", re.MULTILINE)
 HTML_ANEK_REGEX = re.compile(r"<meta name=\"description\" content=\"(.*?)\">", re.DOTALL)
+URL_REGEX = re.compile(r"https?://\S+")
+
+SEARCH_LIMITS = {
+    "iqdb": (iqdb_org.MAX_SIZE, config.IQDB_UPLOAD_MAX_SIDE),
+    "whatanime": (2097152, whatanime_ga.SEARCH_MAX_SIDE),
+}
+"""
+Ограничения загрузки для поисковиков.
+движок <-> (максимальный размер файла, минимальный полезный размер стороны фото)
+"""
 
 EXIT_SUCCESS = 0
 EXIT_UNKNOWN = -256
@@ -98,20 +271,183 @@ not_ready = "\u274e "
 error = "\u203c\ufe0f "
 
 
-def download_and_report_progress(msg: Message, max_file_size: int
-                                 ) -> typing.Optional[typing.Tuple[str, Message]]:
+def select_photo_size(photos: typing.List[PhotoSize], min_side: int) -> PhotoSize:
+    """
+    Выбирает наименьший размер фото, большая сторона которого не меньше ``min_side``.
+
+    :param typing.List[PhotoSize] photos: доступные размеры
+    :param int min_side: минимальный полезный размер стороны
+    :return: подходящий размер или самый большой, если подходящего нет
+    :rtype: PhotoSize
+    """
+    by_area = sorted(photos, key=lambda photo: photo.width * photo.height)
+    for photo in by_area:
+        if max(photo.width, photo.height) >= min_side:
+            return photo
+    return by_area[-1]
+
+
+def send_media_by_url(send: typing.Callable[..., Message], chat_id: int, url: str,
+                      load: typing.Callable[[], bytes], **kwargs) -> Message:
+    """
+    Отправляет медиа ссылкой, чтобы Telegram загрузил его сам.
+    Если Telegram не смог, загружает медиа в память и отправляет файлом.
+
+    :param send: метод бота, например ``bot.send_photo``
+    :param int chat_id: ID чата
+    :param str url: прямая ссылка на медиа
+    :param load: загружает медиа в память
+    :param kwargs: остальные параметры ``send``
+    :return: отправленное сообщение
+    :rtype: Message
+    """
+    try:
+        return send(chat_id, url, **kwargs)
+    except telebot.apihelper.ApiException:
+        log.info(f"telegram failed to fetch {url}, uploading it myself", exc_info=True)
+        return send(chat_id, io.BytesIO(load()), **kwargs)
+
+
+def reply_unavailable(chat_id: int, breaker: circuit_breaker.CircuitBreaker):
+    """
+    Сообщает, что сервис временно отключен предохранителем.
+
+    :param int chat_id: ID чата
+    :param circuit_breaker.CircuitBreaker breaker: предохранитель сервиса
+    """
+    bot.send_message(chat_id, f"Сервис {breaker.name} временно недоступен, попробуй через пару минут.")
+
+
+def quota_allows(chat_id: int) -> bool:
+    """
+    Проверяет, дойдет ли очередь нового запроса к whatanime.ga за ``WHATANIME_MAX_WAIT``; если нет -- сообщает.
+
+    :param int chat_id: ID чата
+    :return: ``True``, если можно ставить запрос в очередь квоты
+    :rtype: bool
+    """
+    queue_position, queue_wait = whatanime_quota.estimate(chat_id)
+    if queue_wait <= config.WHATANIME_MAX_WAIT:
+        return True
+    bot.send_message(chat_id, f"Квота whatanime.ga исчерпана: впереди {queue_position} запросов, "
+                              f"ждать около {queue_wait:.0f} секунд. Попробуй позже или /abort!")
+    return False
+
+
+def has_search_input(msg: Message) -> bool:
     """
-    Загружает файл и сообщает об этом в указанном чате.
+    Проверяет, есть ли в сообщении картинка или ссылка для поиска.
+
+    :param Message msg: сообщение
+    :return: ``True``, если есть фото, документ или ссылка
+    :rtype: bool
+    """
+    return msg.photo is not None or msg.document is not None \
+        or (msg.text is not None and msg.text.startswith(("http://", "https://",)))
+
+
+def format_iqdb_result(result: iqdb_org.IqdbResult) -> str:
+    """
+    Форматирует результат iqdb.org для отправки с ``parse_mode="HTML"``.
+
+    :param iqdb_org.IqdbResult result: результат поиска
+    :return: текст сообщения
+    :rtype: str
+    """
+    out_msg = f"{result.match_type} ({result.similarity}%): {result.rating}, {result.resolution}\n" \
+              f"Preview: {result.preview_link}\n" \
+              f"Sauce: {result.source_link}"
+    if result.tags is not None:
+        out_msg += "\n\nTags: "
+        for tag in result.tags:
+            out_msg += f"<code>{tag}</code> "
+    return out_msg
+
+
+def format_whatanime_result(result: whatanime_ga.WhatAnimeResult) -> str:
+    """
+    Форматирует результат whatanime.ga простым текстом.
+
+    :param whatanime_ga.WhatAnimeResult result: результат поиска
+    :return: текст сообщения
+    :rtype: str
+    """
+    match = "Совпадение" if result.similarity > 0.80 else "Низкая вероятность! Совпадение"
+    return "{0}: {1:.1f}%\n" \
+           "{2} (EP#{3}, в {4:.2f} мин)\n" \
+           "{5}".format(match, result.similarity * 100, result.title, result.episode,
+                        result.at / 60, result.title_english)
+
+
+def get_download_url(msg: Message, engine: str = None, min_photo_side: int = 0) -> typing.Optional[str]:
+    """
+    Возвращает ссылку для загрузки картинки из сообщения: фото, документа или текста.
+
+    :param Message msg: сообщение-источник
+    :param str engine: название поискового движка, для статистики
+    :param int min_photo_side: минимальный полезный размер стороны фото; 0 -- самое большое фото
+    :return: ссылка или ``None``
+    :rtype: typing.Optional[str]
+    """
+    if msg.photo is not None:  # Фото, .jpg
+        photos: typing.List[PhotoSize] = msg.photo
+        if min_photo_side > 0:
+            photo = select_photo_size(photos, min_photo_side)
+        else:
+            photo = photos[-1]  # Biggest resolution
+        if engine is not None:
+            savings = photo_savings.setdefault(engine, [0, 0])
+            savings[0] += photo.file_size or 0
+            savings[1] += photos[-1].file_size or 0
+        log.debug(f"photo {photo.width}x{photo.height} of {photos[-1].width}x{photos[-1].height}")
+        file: File = bot.get_file(photo.file_id)
+        log.debug("pic")
+        return f"https://api.telegram.org/file/bot{config.BOT_TOKEN}/{file.file_path}"
+    elif msg.document is not None:  # Документ, any!
+        document: Document = msg.document
+        file: File = bot.get_file(document.file_id)
+        log.debug("doc")
+        return f"https://api.telegram.org/file/bot{config.BOT_TOKEN}/{file.file_path}"
+    else:  # Ссылка, any!
+        log.debug("text")
+        return msg.text
+
+
+def download_input(download_url: str, max_file_size: int,
+                   progress: typing.Callable[[int, typing.Optional[int], float], None] = None) -> bytes:
+    """
+    Загружает картинку для поиска в память с таймаутами из конфига.
+
+    :param str download_url: ссылка
+    :param int max_file_size: максимальный размер для загрузки
+    :param progress: вызывается с (загружено, всего, скорость)
+    :return: содержимое файла
+    :rtype: bytes
+    :raise download.FileTooLargeError: файл больше ``max_file_size``
+    """
+    # FIXED: tg blocked in Russia, use proxy
+    # noinspection PyProtectedMember
+    return download.stream_download(telebot.apihelper._get_req_session(), download_url, max_file_size,
+                                    timeout=(config.DOWNLOAD_CONNECT_TIMEOUT, config.DOWNLOAD_READ_TIMEOUT),
+                                    min_speed=config.DOWNLOAD_MIN_SPEED,
+                                    proxies=telebot.apihelper.proxy, progress=progress)
+
+
+def download_and_report_progress(msg: Message, max_file_size: int, engine: str = None, min_photo_side: int = 0
+                                 ) -> typing.Optional[typing.Tuple[bytes, Message]]:
+    """
+    Загружает файл в память и сообщает об этом в указанном чате.
 
     :param Message msg: сообщение-источник
     :param int max_file_size: максимальный размер для загрузки
-    :return: путь до скачанного файла И
-    :rtype: typing.Optional[typing.Tuple[str, Message]]
+    :param str engine: название поискового движка, для статистики
+    :param int min_photo_side: минимальный полезный размер стороны фото; 0 -- самое большое фото
+    :return: содержимое скачанного файла И статусное сообщение
+    :rtype: typing.Optional[typing.Tuple[bytes, Message]]
     """
     chat_id = msg.chat.id
-    msg_text = msg.text
 
-    if (msg.photo is None and msg.document is None) and not msg_text.startswith(("http://", "https://",)):
+    if not has_search_input(msg):
         log.debug(f"not link, skipping: {msg.text}")
         return None
 
@@ -121,19 +457,7 @@ def download_and_report_progress(msg: Message, max_file_size: int
                                   not_ready + "Поиск\n" +
                                   not_ready + "Результат\n" +
                                   not_ready + "Превью\n")
-    if msg.photo is not None:  # Фото, .jpg
-        photos: typing.List[PhotoSize] = msg.photo
-        file: File = bot.get_file(photos[-1].file_id)  # Biggest resolution
-        download_url = f"https://api.telegram.org/file/bot{config.BOT_TOKEN}/{file.file_path}"
-        log.debug("pic")
-    elif msg.document is not None:  # Документ, any!
-        document: Document = msg.document
-        file: File = bot.get_file(document.file_id)
-        download_url = f"https://api.telegram.org/file/bot{config.BOT_TOKEN}/{file.file_path}"
-        log.debug("doc")
-    else:  # Ссылка, any!
-        download_url = msg_text
-        log.debug("text")
+    download_url = get_download_url(msg, engine, min_photo_side)
     if download_url is None:
         bot.edit_message_text(error + "Подготовка ссылки\n" +
                               not_ready + "Загрузка\n" +
@@ -154,28 +478,38 @@ def download_and_report_progress(msg: Message, max_file_size: int
                                            not_ready + "Превью\n",
                                            chat_id, status_msg.message_id)
 
-        # response = requests.get(download_url, timeout=4, stream=True)  # FIXED: tg blocked in Russia, use proxy
-        # noinspection PyProtectedMember
-        # response = telebot.apihelper._get_req_session().get(download_url, timeout=4, stream=True)
-        response = telebot.apihelper._get_req_session().request('get', download_url, timeout=4, stream=True,
-                                                                proxies=telebot.apihelper.proxy)
-        data = response.raw.read(max_file_size + 1, decode_content=True)
-        if len(data) > max_file_size:  # 2MB
-            response.close()
-            bot.edit_message_text(ready + "Подготовка ссылки\n" +
-                                  error + "Загрузка\n" +
-                                  not_ready + "Поиск\n" +
-                                  not_ready + "Результат\n" +
-                                  not_ready + "Превью\n",
-                                  chat_id, status_msg.message_id)
-            bot.send_message(chat_id, "Объем данных превышает 2МБ, отменено. Жду еще одного сообщения или /abort!")
-            return None
-        # noinspection PyUnusedLocal
-        rand = "".join(random.choice(string.ascii_letters + string.digits) for x in range(
-            random.randint(16, 32)))
-        search_file_path = os.path.join(tmp_path, f"search_{msg.message_id}_{rand}")
-        with open(search_file_path, mode="wb") as file:
-            file.write(data)
+        last_report = time.monotonic()
+
+        def report_progress(loaded: int, total: typing.Optional[int], speed: float):
+            """
+            Показывает ход загрузки, не чаще раза в пару секунд.
+            """
+            nonlocal last_report
+            if time.monotonic() - last_report < 2:
+                return
+            last_report = time.monotonic()
+            of_total = f"/{total // 1024}" if total is not None else ""
+            try:
+                bot.edit_message_text(ready + "Подготовка ссылки\n" +
+                                      pending + f"Загрузка ({loaded // 1024}{of_total} КБ, {speed / 1024:.0f} КБ/с)\n" +
+                                      not_ready + "Поиск\n" +
+                                      not_ready + "Результат\n" +
+                                      not_ready + "Превью\n",
+                                      chat_id, status_msg.message_id)
+            except telebot.apihelper.ApiException:  # 429, "message is not modified" -- не повод прерывать загрузку
+                log.debug("progress edit failed", exc_info=True)
+
+        data = download_input(download_url, max_file_size, report_progress)
+    except download.FileTooLargeError:
+        bot.edit_message_text(ready + "Подготовка ссылки\n" +
+                              error + "Загрузка\n" +
+                              not_ready + "Поиск\n" +
+                              not_ready + "Результат\n" +
+                              not_ready + "Превью\n",
+                              chat_id, status_msg.message_id)
+        bot.send_message(chat_id, f"Объем данных превышает {max_file_size / 1024 / 1024:.0f}МБ, отменено. "
+                                  f"Жду еще одного сообщения или /abort!")
+        return None
     except Exception as exc:
         bot.edit_message_text(ready + "Подготовка ссылки\n" +
                               error + "Загрузка\n" +
@@ -187,12 +521,6 @@ def download_and_report_progress(msg: Message, max_file_size: int
                                   "Подробнее: {}".format(exc))
         # log.debug("{}".format(traceback.format_exc()))
         log.info("dload fail:", exc_info=True)
-        # noinspection PyBroadException
-        try:
-            # noinspection PyUnboundLocalVariable
-            os.remove(os.path.realpath(search_file_path))
-        except:
-            pass
         return None
 
     status_msg = bot.edit_message_text(ready + "Подготовка ссылки\n" +
@@ -201,50 +529,335 @@ def download_and_report_progress(msg: Message, max_file_size: int
                                        not_ready + "Результат\n" +
                                        not_ready + "Превью\n",
                                        chat_id, status_msg.message_id)
-    return search_file_path, status_msg
+    return data, status_msg
 
 
-def run_neuroshit(msg_length: int, start_text: str) -> str:
+def get_file_unique_id(msg: Message) -> typing.Optional[str]:
     """
-    Пытается сгенерировать бред с помощью torch-rnn.
+    Возвращает ``file_unique_id`` картинки из сообщения, если она там есть.
 
-    :param int msg_length: желаемая длина результата
-    :param str start_text: текст, передаваемый в нейросеть
-    :return: бред
+    :param Message msg: сообщение
+    :return: уникальный ID файла или ``None``
+    :rtype: typing.Optional[str]
+    """
+    if msg.photo is not None:
+        return getattr(msg.photo[-1], "file_unique_id", None)
+    if msg.document is not None:
+        return getattr(msg.document, "file_unique_id", None)
+    return None
+
+
+def prepare_search(msg: Message, engine: str, max_file_size: int, min_photo_side: int
+                   ) -> typing.Optional[typing.Tuple[typing.Optional[bytes], typing.Optional[list],
+                                                     typing.Optional[str], Message]]:
+    """
+    Ищет результат в кэше по ``file_unique_id``, при промахе загружает картинку.
+    Дальше поиск идет через :func:`cached_search`.
+
+    :param Message msg: сообщение-источник
+    :param str engine: название поискового движка
+    :param int max_file_size: максимальный размер для загрузки
+    :param int min_photo_side: минимальный полезный размер стороны фото
+    :return: содержимое картинки (``None`` при попадании по ID), результаты из кэша или ``None``,
+             ключ ``file_unique_id`` для кэша И статусное сообщение
+    :rtype: typing.Optional[typing.Tuple[typing.Optional[bytes], typing.Optional[list],
+            typing.Optional[str], Message]]
+    """
+    tg_key = result_cache.file_key(get_file_unique_id(msg))
+    results = search_cache.get(engine, tg_key)
+    if results is not None:
+        log.debug(f"{engine} cache hit: {tg_key}")
+        status_msg = bot.send_message(msg.chat.id, ready + "Подготовка ссылки\n" +
+                                      ready + "Загрузка (кэш)\n" +
+                                      pending + "Поиск\n" +
+                                      not_ready + "Результат\n" +
+                                      not_ready + "Превью\n")
+        return None, results, tg_key, status_msg
+
+    try:
+        search_data, status_msg = download_and_report_progress(msg, max_file_size, engine, min_photo_side)
+    except TypeError:
+        return None
+    return search_data, None, tg_key, status_msg
+
+
+def run_engine_search(engine: str, chat_id: int, search_data: bytes,
+                      on_queued: typing.Callable[[int, float], None] = None) -> list:
+    """
+    Ищет картинку указанным движком через его предохранитель.
+    Для whatanime.ga сначала дожидается своей очереди в квоте.
+
+    :param str engine: название поискового движка
+    :param int chat_id: ID чата, для очереди квоты
+    :param bytes search_data: содержимое картинки
+    :param on_queued: вызывается с (запросов впереди, ожидание), если квота на исходе
+    :return: результаты поиска
+    :rtype: list
+    """
+    if engine == "whatanime":
+        if not breakers["whatanime"].allow():
+            raise circuit_breaker.CircuitOpenError(breakers["whatanime"].name)  # Не тратим квоту впустую
+        whatanime_quota.wait_turn(chat_id, config.WHATANIME_MAX_WAIT, on_queued)
+        results = breakers["whatanime"].call(whatanime.search, search_data)
+        whatanime_quota.update(whatanime.now_quota, whatanime.quota_expire)
+        return results
+    return breakers["iqdb"].call(iqdb.search, search_data)
+
+
+def cached_search(engine: str, chat_id: int, search_data: bytes, tg_key: typing.Optional[str] = None,
+                  on_queued: typing.Callable[[int, float], None] = None) -> list:
+    """
+    Ищет загруженную картинку сначала в кэше: по хешу содержимого, затем по перцептивному хешу.
+    При промахе ищет движком (см. :func:`run_engine_search`) и сохраняет результат под всеми ключами.
+
+    :param str engine: название поискового движка
+    :param int chat_id: ID чата, для очереди квоты
+    :param bytes search_data: содержимое картинки
+    :param tg_key: ключ ``file_unique_id`` или ``None``
+    :param on_queued: вызывается с (запросов впереди, ожидание), если квота на исходе
+    :return: результаты поиска
+    :rtype: list
+    """
+    data_key = result_cache.content_key(search_data)
+    results = search_cache.get(engine, data_key)
+    if results is not None:
+        log.debug(f"{engine} cache hit: {data_key}")
+        search_cache.put(engine, results, tg_key)  # Тот же файл, пересланный заново
+        return results
+
+    phash = None
+    if config.SEARCH_CACHE_SIMILARITY > 0:
+        try:
+            phash = image_pool.run_in_pool(images, image_hash.dhash_bytes, search_data)
+            results = search_cache.get_similar(engine, phash, config.SEARCH_CACHE_SIMILARITY)
+        except (IOError, image_pool.PoolBusyError, image_pool.BrokenProcessPool):
+            pass  # Не картинка, пул занят или сломан: ошибку покажет сам поиск
+        if results is not None:
+            log.debug(f"{engine} similar cache hit: {data_key}")
+            search_cache.put(engine, results, tg_key, data_key)
+            return results
+
+    results = run_engine_search(engine, chat_id, search_data, on_queued)
+    search_cache.put(engine, results, tg_key, data_key, phash=phash)
+    return results
+
+
+def format_batch_line(engine: str, result) -> str:
+    """
+    Форматирует лучший результат одной картинки для пакетного ответа (``parse_mode="HTML"``).
+
+    :param str engine: название поискового движка
+    :param result: лучший результат поиска
+    :return: одна строка ответа
+    :rtype: str
+    """
+    if engine == "whatanime":
+        return html.escape("{0} EP#{1}, в {2:.2f} мин ({3:.1f}%)".format(result.title_romaji, result.episode,
+                                                                          result.at / 60, result.similarity * 100))
+    return f"{result.match_type} ({result.similarity}%): {result.source_link}"
+
+
+# noinspection PyBroadException
+def search_batch(chat_id: int, engine: str, items: typing.List[typing.Union[Message, str]]):
+    """
+    Ищет несколько картинок параллельно и отвечает одним сообщением.
+
+    :param int chat_id: ID чата
+    :param str engine: название поискового движка
+    :param items: сообщения с картинками (альбом) или ссылки
+    """
+    if breakers[engine].is_open:
+        reply_unavailable(chat_id, breakers[engine])
+        return
+    if engine == "whatanime" and not quota_allows(chat_id):
+        return
+    skipped = len(items) - config.BATCH_MAX_ITEMS
+    items = items[:config.BATCH_MAX_ITEMS]
+    max_file_size, min_photo_side = SEARCH_LIMITS[engine]
+    status_msg = bot.send_message(chat_id, pending + f"Пакетный поиск: 0/{len(items)}")
+
+    def search_item(item: typing.Union[Message, str]) -> list:
+        """
+        Загружает и ищет одну картинку, сначала в кэше.
+        """
+        if isinstance(item, str):
+            tg_key, download_url = None, item
+        else:
+            tg_key = result_cache.file_key(get_file_unique_id(item))
+            results = search_cache.get(engine, tg_key)
+            if results is not None:
+                return results
+            download_url = get_download_url(item, engine, min_photo_side)
+        return cached_search(engine, chat_id, download_input(download_url, max_file_size), tg_key)
+
+    lines: typing.List[str] = [""] * len(items)
+    found = False
+    done = 0
+    futures = {search_executor.submit(search_item, item): index for index, item in enumerate(items)}
+    for future in concurrent.futures.as_completed(futures):
+        index = futures[future]
+        try:
+            results = future.result()
+            if results:
+                lines[index] = format_batch_line(engine, results[0])
+                found = True
+            else:
+                lines[index] = "ничего не найдено"
+        except download.FileTooLargeError:
+            lines[index] = f"больше {max_file_size / 1024 / 1024:.0f}МБ, пропущено"
+        except Exception as exc:
+            lines[index] = f"ошибка ({html.escape(str(exc))})"
+            log.info("batch item fail:", exc_info=True)
+        done += 1
+        bot.edit_message_text(pending + f"Пакетный поиск: {done}/{len(items)}", chat_id, status_msg.message_id)
+
+    bot.edit_message_text((ready if found else error) + f"Пакетный поиск: {done}/{len(items)}",
+                          chat_id, status_msg.message_id)
+    out_msg = "\n\n".join(f"{index + 1}. {line}" for index, line in enumerate(lines))
+    if skipped > 0:
+        out_msg += f"\n\nЕще {skipped} пропущено: не больше {config.BATCH_MAX_ITEMS} за раз."
+    bot.send_message(chat_id, out_msg, parse_mode="HTML", disable_web_page_preview=True)
+    if found:
+        chat_states[chat_id].state_name = chat_state.NONE
+    else:
+        bot.send_message(chat_id, "Ничего не нашел. Жду еще одного сообщения или /abort!")
+
+
+def search_class(engine: str) -> str:
+    """
+    Класс допуска для поиска движком: у whatanime.ga свой, чтобы ожидание квоты не задерживало iqdb.org.
+
+    :param str engine: название поискового движка
+    :return: класс команд
     :rtype: str
-    :raise: SubprocessError при ошибке или через 10 секунд
     """
-    result = subprocess.run(
-        cwd=config.NEURO_WORKDIR,  # Working directory
-        args=[
+    return "whatanime" if engine == "whatanime" else "search"
+
+
+# noinspection PyBroadException
+def flush_media_group(group_key: typing.Tuple[int, str], engine: str):
+    """
+    Ставит пакетный поиск по собранному альбому в очередь поиска.
+
+    :param group_key: (ID чата, ``media_group_id``)
+    :param str engine: название поискового движка
+    """
+    with media_groups_lock:
+        messages = media_groups.pop(group_key, [])
+        media_group_timers.pop(group_key, None)
+    if not messages:
+        return
+    messages.sort(key=lambda album_msg: album_msg.message_id)
+    try:
+        submit_heavy(search_class(engine), messages[0], search_batch, group_key[0], engine, messages)
+    except:
+        log.warning("batch search submit failed", exc_info=True)
+
+
+def batch_urls(msg: Message) -> typing.List[str]:
+    """
+    Извлекает ссылки для пакетного поиска из текста.
+
+    :param Message msg: сообщение
+    :return: ссылки, если их больше одной, иначе пустой список
+    :rtype: typing.List[str]
+    """
+    if msg.text is None:
+        return []
+    urls = [url.rstrip(".,;:!?)") for url in URL_REGEX.findall(msg.text)]
+    return urls if len(urls) > 1 else []
+
+
+def collect_batch(msg: Message, engine: str) -> bool:
+    """
+    Перехватывает сообщения для пакетного поиска.
+    Фото альбома приходят отдельными сообщениями: они копятся, пока альбом не перестанет пополняться.
+    Текст с несколькими ссылками сразу ставится в очередь поиска.
+
+    :param Message msg: сообщение
+    :param str engine: название поискового движка
+    :return: ``True``, если сообщение ушло в пакетный поиск
+    :rtype: bool
+    """
+    chat_id = msg.chat.id
+    media_group_id = getattr(msg, "media_group_id", None)
+    if media_group_id is not None:
+        group_key = (chat_id, media_group_id)
+        with media_groups_lock:
+            media_groups.setdefault(group_key, []).append(msg)
+            timer = media_group_timers.get(group_key)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(config.MEDIA_GROUP_WAIT, flush_media_group, (group_key, engine))
+            timer.daemon = True
+            media_group_timers[group_key] = timer
+            timer.start()
+        return True
+    urls = batch_urls(msg)
+    if urls:
+        submit_heavy(search_class(engine), msg, search_batch, chat_id, engine, urls)
+        return True
+    return False
+
+
+def make_neuro_pool() -> sampler_pool.SamplerPool:
+    """
+    Создает пул генераторов torch-rnn (или заглушек, если задан ``NEURO_STANDIN``).
+
+    :return: незапущенный пул
+    :rtype: sampler_pool.SamplerPool
+    """
+    if config.NEURO_STANDIN:
+        args = [
+            sys.executable,
+            pkg_resources.resource_filename(config.NEURO, config.NEURO_STANDIN_SCRIPT),
+        ]
+    else:
+        args = [
             f"th",  # main executable
-            f"./sample.lua",  # NN script
+            pkg_resources.resource_filename(config.NEURO, config.NEURO_SERVER),  # NN script, loads model once
 
             f"-gpu",
             f"{config.NEURO_GPU}",  # GPU num
 
             f"-checkpoint",
             f"{config.NEURO_MODEL_PATH}",  # NN model
+        ]
+    return sampler_pool.SamplerPool(args, cwd=config.NEURO_WORKDIR, size=config.NEURO_WORKERS,
+                                    timeout=config.NEURO_TIMEOUT, startup_timeout=config.NEURO_STARTUP_TIMEOUT)
 
-            f"-sample",  # sample from the next-character distribution at each timestep
-            f"1",
 
-            f"-temperature",  # Softmax temperature to use when sampling
-            f"{config.NEURO_TEMP}",  # Higher temperatures give noiser samples
+def run_neuroshit(msg_length: int, start_text: str,
+                  on_partial: typing.Callable[[str], None] = None) -> str:
+    """
+    Пытается сгенерировать бред с помощью torch-rnn.
 
-            f"-length",
-            f"{msg_length}",
+    :param int msg_length: желаемая длина результата
+    :param str start_text: текст, передаваемый в нейросеть
+    :param on_partial: вызывается с уже сгенерированной частью бреда
+    :return: бред
+    :rtype: str
+    :raise: SubprocessError при ошибке или через ``NEURO_TIMEOUT`` секунд (часть бреда -- в ``output``)
+    """
+    return neuro_pool.sample(msg_length, start_text, config.NEURO_TEMP, on_partial)
 
-            f"-start_text",
-            f"{start_text}"
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        timeout=10,  # in secs
-        check=True,
-        universal_newlines=True,
-    )
-    return result.stdout
+
+def refresh_iqdb_status():
+    """
+    Обновляет статус бур iqdb.org в фоне и сохраняет последний удачный снимок на диск.
+    Ошибки не отключают модуль: остается предыдущий снимок, попытка повторяется позже.
+    """
+    status_save_path = os.path.join(saves_path, "iqdb_status.pkl")
+    while True:
+        # noinspection PyBroadException
+        try:
+            iqdb.get_status()
+            log.info(f"iqdb status refreshed: {len(iqdb.boorus_status)} boorus")
+            with open(status_save_path, "w+b") as status_file:
+                pickle.dump((iqdb.boorus_status, iqdb.status_updated), status_file, pickle.HIGHEST_PROTOCOL)
+        except:
+            log.warning("iqdb status refresh failed, keeping old snapshot", exc_info=True)
+        time.sleep(config.IQDB_STATUS_REFRESH)
 
 
 def chat_in_state(chat_msg: Message, state_name: str) -> bool:
@@ -280,6 +893,61 @@ def is_admin(chat_msg: Message) -> bool:
     return True if sender.username == config.ADMIN_USERNAME else False
 
 
+def submit_heavy(command_class: str, msg: Message, func: typing.Callable, *args):
+    """
+    Ставит ``func(*args)`` в очередь класса команд от имени автора сообщения.
+    Отказ или место в очереди сообщается в чат сразу.
+
+    :param str command_class: название класса команд
+    :param Message msg: сообщение, за которое списывается частота запросов
+    :param func: задача
+    :param args: аргументы
+    """
+    chat_id = msg.chat.id
+    user_id = msg.from_user.id if msg.from_user is not None else None
+    try:
+        ahead, wait = gatekeeper.submit(command_class, chat_id, user_id, func, *args)
+    except admission.RateLimitedError as exc:
+        bot.send_message(chat_id, f"Слишком часто! Попробуй через {max(exc.wait, 1):.0f} сек.")
+        return
+    except admission.QueueFullError:
+        bot.send_message(chat_id, "Слишком много запросов, я занят. Попробуй чуть позже.")
+        return
+    if ahead > 0:
+        eta = f", ждать около {max(wait, 1):.0f} сек." if wait > 0 else "."
+        bot.send_message(chat_id, f"Принято! Впереди (вместе с выполняемыми): {ahead}{eta}")
+
+
+def admitted(command_class: str, when: typing.Callable[[Message], bool] = lambda msg: True):
+    """
+    Декоратор тяжелых обработчиков: проверяет частоту запросов и выполняет обработчик
+    в очереди класса команд, освобождая поток TeleBot. Отказ или место в очереди сообщается сразу.
+
+    :param str command_class: название класса команд
+    :param when: проверять только сообщения, для которых вернет ``True``; остальные выполняются сразу
+    """
+    def decorator(handler: typing.Callable[[Message], None]):
+        @functools.wraps(handler)
+        def wrapper(msg: Message):
+            if not when(msg):
+                return handler(msg)
+            submit_heavy(command_class, msg, handler, msg)
+        return wrapper
+    return decorator
+
+
+def is_search_request(msg: Message) -> bool:
+    """
+    Проверяет, запускает ли сообщение одиночный поиск
+    (фото альбома и несколько ссылок ставятся в очередь отдельно, одним пакетом).
+
+    :param Message msg: сообщение
+    :return: ``True`` для картинки или ссылки не из альбома
+    :rtype: bool
+    """
+    return has_search_input(msg) and getattr(msg, "media_group_id", None) is None and not batch_urls(msg)
+
+
 @bot.message_handler(commands=["abort", ])
 @bot.channel_post_handler(commands=["abort", ])
 def bot_cmd_abort(msg: Message):
@@ -371,6 +1039,34 @@ def bot_cmd_send_msg(msg: Message):
         bot.send_message(chat_id, "Exception: {}\n{}".format(exc, traceback.format_exc()))
 
 
+@bot.message_handler(commands=["iqdb_status", ], func=is_admin)
+@bot.channel_post_handler(commands=["iqdb_status", ], func=is_admin)
+def bot_cmd_iqdb_status(msg: Message):
+    """
+    Показывает сохраненный статус бур iqdb.org и его свежесть.
+    Доступно только администратору.
+
+    :param Message msg: сообщение
+    """
+    bot_all_messages(msg)
+    chat_id = msg.chat.id
+    if iqdb_disabled:
+        bot.send_message(chat_id, "Модуль iqdb.org отключен.")
+        return
+    if iqdb.boorus_status is None:
+        bot.send_message(chat_id, "Статус бур еще не получен.")
+        return
+    age = datetime.timedelta(seconds=int(time.time() - iqdb.status_updated))
+    result = f"Обновлено <code>{age}</code> назад:\n"
+    for booru in iqdb.boorus_status:
+        result += f"<code>{booru}</code>"
+        if booru.update_fail_count:
+            result += f" (ошибок: {booru.update_fail_count}, {booru.update_fail_reason})"
+        result += "\n"
+    for splitted in util.split_string(result, 3000):
+        bot.send_message(chat_id, splitted, parse_mode="HTML")
+
+
 @bot.message_handler(commands=["info", ])
 @bot.channel_post_handler(commands=["info", ])
 def bot_cmd_info(msg: Message):
@@ -400,6 +1096,15 @@ def bot_cmd_info(msg: Message):
     net_write_gb = psutil.net_io_counters().bytes_sent / 1024 / 1024 / 1024
     net_pretty = f"принято {net_read_gb:.1f} GB/передано {net_write_gb:.1f} GB"
 
+    savings_pretty = ", ".join(f"{engine} {loaded / 1024 / 1024:.1f}/{largest / 1024 / 1024:.1f} MB"
+                               for engine, (loaded, largest) in photo_savings.items()) or "нет данных"
+
+    breakers_pretty = ", ".join(str(breaker) for breaker in breakers.values())
+
+    neuro_buffer_pretty = str(neuro_buffer) if neuro_buffer is not None else "отключен"
+    gatekeeper_pretty = str(gatekeeper)
+    prefetch_pretty = f"{quotes}, анеков {len(aneks)} (до #{aneks.max_id})"
+
     tc = chat_states[chat_id]
     chat_info = f"""ID: <code>{chat_id}</code>
     Состояние (/abort для сброса): <code>{tc.state_name}</code>
@@ -413,6 +1118,11 @@ def bot_cmd_info(msg: Message):
                f"    RAM: <code>{mem_pretty}</code>\n"
                f"    HDD (<code>/</code>): <code>{disc_pretty}</code>\n"
                f"    Сеть: <code>{net_pretty}</code>\n"
+               f"    Фото для поиска (скачано/максимум): <code>{savings_pretty}</code>\n"
+               f"    Внешние сервисы: <code>{breakers_pretty}</code>\n"
+               f"    Запас /neuroshit: <code>{neuro_buffer_pretty}</code>\n"
+               f"    Тяжелые команды (в работе/потоков): <code>{gatekeeper_pretty}</code>\n"
+               f"    Запас цитат и анеков: <code>{prefetch_pretty}</code>\n"
                f"\n"
                f"<b>Чат:</b>\n"
                f"    {chat_info}\n"
@@ -442,6 +1152,7 @@ def bot_msg_everyone(msg: Message):
                      content_types=["text", "document", "photo"])
 @bot.channel_post_handler(func=lambda msg: chat_in_state(msg, chat_state.IQDB),
                           content_types=["text", "document", "photo"])
+@admitted("search", when=is_search_request)
 def bot_process_iqdb(msg: Message):
     """
     Ищет арт на бурах с помощью `iqdb.org`.
@@ -450,14 +1161,22 @@ def bot_process_iqdb(msg: Message):
     """
     bot_all_messages(msg)
     chat_id = msg.chat.id
+    if collect_batch(msg, "iqdb"):
+        return
+
+    if has_search_input(msg) and breakers["iqdb"].is_open:
+        reply_unavailable(chat_id, breakers["iqdb"])
+        return
 
     try:
-        search_file_path, status_msg = download_and_report_progress(msg, iqdb_org.MAX_SIZE)
+        search_data, results, tg_key, status_msg = prepare_search(msg, "iqdb", iqdb_org.MAX_SIZE,
+                                                                  config.IQDB_UPLOAD_MAX_SIDE)
     except TypeError:
         return
 
     try:
-        results: typing.List[iqdb_org.IqdbResult] = iqdb.search(search_file_path)
+        if results is None:
+            results: typing.List[iqdb_org.IqdbResult] = cached_search("iqdb", chat_id, search_data, tg_key)
         result = results[0]
         bot.edit_message_text(ready + "Подготовка ссылки\n" +
                               ready + "Загрузка\n" +
@@ -465,14 +1184,7 @@ def bot_process_iqdb(msg: Message):
                               ready + "Результат\n" +
                               ready + "Превью\n",
                               chat_id, status_msg.message_id)
-        out_msg = f"{result.match_type} ({result.similarity}%): {result.rating}, {result.resolution}\n" \
-                  f"Preview: {result.preview_link}\n" \
-                  f"Sauce: {result.source_link}"
-        if result.tags is not None:
-            out_msg += "\n\nTags: "
-            for tag in result.tags:
-                out_msg += f"<code>{tag}</code> "
-        bot.send_message(chat_id, out_msg, parse_mode="HTML")
+        bot.send_message(chat_id, format_iqdb_result(result), parse_mode="HTML")
         chat_states[chat_id].state_name = chat_state.NONE
     except Exception as exc:
         bot.edit_message_text(ready + "Подготовка ссылки\n" +
@@ -485,17 +1197,12 @@ def bot_process_iqdb(msg: Message):
                                   f"Подробнее: {exc}")
         log.info("search fail:", exc_info=True)
 
-    # noinspection PyBroadException
-    try:
-        os.remove(os.path.realpath(search_file_path))
-    except:
-        pass
-
 
 @bot.message_handler(func=lambda msg: chat_in_state(msg, chat_state.WHATANIME),
                      content_types=["text", "document", "photo"])
 @bot.channel_post_handler(func=lambda msg: chat_in_state(msg, chat_state.WHATANIME),
                           content_types=["text", "document", "photo"])
+@admitted("whatanime", when=is_search_request)
 def bot_process_whatanime(msg: Message):
     """
     Ищет скриншот из аниме с помощью `whatanime.ga`.
@@ -504,25 +1211,42 @@ def bot_process_whatanime(msg: Message):
     """
     bot_all_messages(msg)
     chat_id = msg.chat.id
+    if collect_batch(msg, "whatanime"):
+        return
+
+    if has_search_input(msg) and breakers["whatanime"].is_open:
+        reply_unavailable(chat_id, breakers["whatanime"])
+        return
+    if has_search_input(msg) and not quota_allows(chat_id):
+        return
+
+    def report_queued(position: int, wait: float):
+        """
+        Сообщает место в очереди квоты.
+        """
+        bot.send_message(chat_id, f"Квота whatanime.ga на исходе, жду очереди: впереди {position} запросов, "
+                                  f"около {wait:.0f} секунд.")
 
     try:
-        search_file_path, status_msg = download_and_report_progress(msg, 2097152)
+        search_data, results, tg_key, status_msg = prepare_search(msg, "whatanime", 2097152,
+                                                                  whatanime_ga.SEARCH_MAX_SIDE)
     except TypeError:
         return
 
     # Search!
     try:
-        results: typing.List[whatanime_ga.WhatAnimeResult] = whatanime.search(search_file_path)
+        if results is None:
+            results: typing.List[whatanime_ga.WhatAnimeResult] = cached_search("whatanime", chat_id, search_data,
+                                                                                tg_key, report_queued)
+        # Вообще-то, результатов обычно несколько. Но мне слишком лень писать сложную обработку, поэтому довольствуемся
+        # самым подходящим.
+        result = results[0]
         status_msg = bot.edit_message_text(ready + "Подготовка ссылки\n" +
                                            ready + "Загрузка\n" +
                                            ready + "Поиск\n" +
                                            pending + "Результат\n" +
                                            not_ready + "Превью\n",
                                            chat_id, status_msg.message_id)
-        # Вообще-то, результатов обычно несколько. Но мне слишком лень писать сложную обработку, поэтому довольствуемся
-        # самым подходящим.
-        result = results[0]
-        result.load_thumbnail()
         bot.send_message(chat_id, f"<code>{result.title_romaji}</code>", parse_mode="HTML")
         status_msg = bot.edit_message_text(ready + "Подготовка ссылки\n" +
                                            ready + "Загрузка\n" +
@@ -533,14 +1257,15 @@ def bot_process_whatanime(msg: Message):
                                            .format(whatanime.now_quota,
                                                    whatanime.quota_expire),
                                            chat_id, status_msg.message_id)
-        match = "Совпадение" if result.similarity > 0.80 else "Низкая вероятность! Совпадение"
-        out_msg = "{0}: {1:.1f}%\n" \
-                  "{2} (EP#{3}, в {4:.2f} мин)\n" \
-                  "{5}".format(match, result.similarity * 100, result.title, result.episode,
-                               result.at / 60, result.title_english)
-        with open(result.thumb_path, mode="rb") as file:
-            bot.send_photo(chat_id, file, out_msg)
-        os.remove(result.thumb_path)
+        out_msg = format_whatanime_result(result)
+        send_media_by_url(bot.send_photo, chat_id, result.thumbnail_url,
+                          lambda: result.load_thumbnail(whatanime.session), caption=out_msg)
+        # Превью ставится в очередь только после миниатюры, иначе видео может прийти раньше нее.
+        # Пока Telegram загружает видео, обработчик обновляет статус.
+        preview_future = media_executor.submit(
+            send_media_by_url, bot.send_video, chat_id, result.preview_url,
+            lambda: result.load_preview(whatanime.session),
+            caption="{0:.2f} - {1:.2f}".format(result.__dict__["from"] / 60, result.to / 60))
     except Exception as exc:
         bot.edit_message_text(ready + "Подготовка ссылки\n" +
                               ready + "Загрузка\n" +
@@ -551,17 +1276,12 @@ def bot_process_whatanime(msg: Message):
         bot.send_message(chat_id, "Ошибка при поиске. Жду еще одного сообщения или /abort!\n"
                                   "Подробнее: {}".format(exc))
         log.info("search fail:", exc_info=True)
-        os.remove(os.path.realpath(search_file_path))
         return
 
     # Preview!
     try:
-        result.load_preview()
-        out_msg = "{0:.2f} - {1:.2f}".format(result.__dict__["from"] / 60, result.to / 60)
         bot.send_chat_action(chat_id, "record_video")
-        with open(result.preview_path, mode="rb") as file:
-            bot.send_video(chat_id, file, caption=out_msg)
-        os.remove(result.preview_path)
+        preview_future.result()
         bot.edit_message_text(ready + "Подготовка ссылки\n" +
                               ready + "Загрузка\n" +
                               ready + "Поиск\n" +
@@ -581,10 +1301,131 @@ def bot_process_whatanime(msg: Message):
                               chat_id, status_msg.message_id)
         log.debug("preview fail:", exc_info=True)
 
-    os.remove(os.path.realpath(search_file_path))
     chat_states[chat_id].state_name = chat_state.NONE
 
 
+def is_confident(engine: str, result) -> bool:
+    """
+    Проверяет, достаточно ли уверен поисковик в результате.
+
+    :param str engine: название поискового движка
+    :param result: лучший результат поиска
+    :return: ``True``, если совпадение не ниже 80%
+    :rtype: bool
+    """
+    if engine == "whatanime":
+        return result.similarity > 0.80
+    return int(result.similarity) >= 80
+
+
+# noinspection PyBroadException
+@bot.message_handler(func=lambda msg: chat_in_state(msg, chat_state.SAUCE),
+                     content_types=["text", "document", "photo"])
+@bot.channel_post_handler(func=lambda msg: chat_in_state(msg, chat_state.SAUCE),
+                          content_types=["text", "document", "photo"])
+# Без пакетного поиска: каждая картинка -- отдельный запрос. Класс whatanime: запрос тоже ждет квоты
+@admitted("whatanime", when=has_search_input)
+def bot_process_sauce(msg: Message):
+    """
+    Ищет картинку сразу в `iqdb.org` и `whatanime.ga`.
+    Картинка загружается один раз, поисковики опрашиваются параллельно.
+    Первый уверенный результат отправляется сразу, второй дописывается в то же сообщение.
+
+    :param Message msg: сообщение
+    """
+    bot_all_messages(msg)
+    chat_id = msg.chat.id
+
+    engines: typing.List[str] = []
+    if not iqdb_disabled and not breakers["iqdb"].is_open:
+        engines.append("iqdb")
+    if not whatanime_disabled and not breakers["whatanime"].is_open \
+            and whatanime_quota.estimate(chat_id)[1] <= config.WHATANIME_MAX_WAIT:
+        engines.append("whatanime")
+    if has_search_input(msg) and not engines:
+        bot.send_message(chat_id, "Все поисковики сейчас недоступны, попробуй через пару минут или /abort!")
+        return
+
+    tg_key = result_cache.file_key(get_file_unique_id(msg))
+    cached = {engine: search_cache.get(engine, tg_key) for engine in engines}
+    if engines and None not in cached.values():
+        search_data = None
+        status_msg = bot.send_message(chat_id, ready + "Подготовка ссылки\n" +
+                                      ready + "Загрузка (кэш)\n" +
+                                      pending + "Поиск\n" +
+                                      not_ready + "Результат\n" +
+                                      not_ready + "Превью\n")
+    else:
+        try:
+            search_data, status_msg = download_and_report_progress(
+                msg, iqdb_org.MAX_SIZE, "sauce", max(config.IQDB_UPLOAD_MAX_SIDE, whatanime_ga.SEARCH_MAX_SIDE))
+        except TypeError:
+            return
+
+    def report_queued(position: int, wait: float):
+        """
+        Сообщает место в очереди квоты.
+        """
+        bot.send_message(chat_id, f"Квота whatanime.ga на исходе, жду очереди: впереди {position} запросов, "
+                                  f"около {wait:.0f} секунд.")
+
+    def search(engine: str) -> list:
+        """
+        Ищет картинку одним движком, сначала в кэше.
+        """
+        if cached[engine] is not None:
+            return cached[engine]
+        return cached_search(engine, chat_id, search_data, tg_key, report_queued)
+
+    titles = {"iqdb": "iqdb.org", "whatanime": "whatanime.ga"}
+    sections: typing.List[typing.Tuple[bool, str]] = []
+    found = False
+    reply_msg = None
+    futures = {search_executor.submit(search, engine): engine for engine in engines}
+    for future in concurrent.futures.as_completed(futures):
+        engine = futures[future]
+        try:
+            results = future.result()
+            if not results:
+                sections.append((False, f"<b>{titles[engine]}</b>: ничего не найдено"))
+                continue
+            result = results[0]
+            if engine == "whatanime":
+                text = html.escape(format_whatanime_result(result))
+            else:
+                text = format_iqdb_result(result)
+            sections.append((is_confident(engine, result), f"<b>{titles[engine]}</b>\n{text}"))
+            found = True
+        except Exception as exc:
+            sections.append((False, f"<b>{titles[engine]}</b>: ошибка ({html.escape(str(exc))})"))
+            log.info("search fail:", exc_info=True)
+        finally:
+            # Уверенные результаты выше, остальные в порядке поступления
+            out_msg = "\n\n".join(text for _, text in sorted(sections, key=lambda section: not section[0]))
+            if reply_msg is None:
+                reply_msg = bot.send_message(chat_id, out_msg, parse_mode="HTML", disable_web_page_preview=True)
+            else:
+                bot.edit_message_text(out_msg, chat_id, reply_msg.message_id, parse_mode="HTML",
+                                      disable_web_page_preview=True)
+
+    if found:
+        bot.edit_message_text(ready + "Подготовка ссылки\n" +
+                              ready + "Загрузка\n" +
+                              ready + "Поиск\n" +
+                              ready + "Результат\n" +
+                              not_ready + "Превью\n",
+                              chat_id, status_msg.message_id)
+        chat_states[chat_id].state_name = chat_state.NONE
+    else:
+        bot.edit_message_text(ready + "Подготовка ссылки\n" +
+                              ready + "Загрузка\n" +
+                              error + "Поиск\n" +
+                              not_ready + "Результат\n" +
+                              not_ready + "Превью\n",
+                              chat_id, status_msg.message_id)
+        bot.send_message(chat_id, "Ничего не нашел. Жду еще одного сообщения или /abort!")
+
+
 @bot.message_handler(func=lambda msg: chat_in_state(msg, chat_state.CONFIGURE_VK_GROUPS_ADD))
 @bot.channel_post_handler(func=lambda msg: chat_in_state(msg, chat_state.CONFIGURE_VK_GROUPS_ADD))
 def bot_process_configuration_vk(msg: Message):
@@ -704,6 +1545,7 @@ def bot_cmd_configuration_vk(msg: Message):
 
 @bot.message_handler(commands=["neuroshit", ])
 @bot.channel_post_handler(commands=["neuroshit", ])
+@admitted("neuroshit")
 def bot_cmd_neuroshit(msg: Message):
     """
     Генерирует бред нейросетью.
@@ -717,7 +1559,7 @@ def bot_cmd_neuroshit(msg: Message):
         bot.send_message(chat_id, "Модуль Neuroshit отключен.")
         return
 
-    start_text = random.choice(string.ascii_letters)
+    start_text = None
 
     args = msg.text.split(" ")[1:]
     if len(args) <= 0:
@@ -727,7 +1569,7 @@ def bot_cmd_neuroshit(msg: Message):
             length = int(args[0])
         except:
             length = 150
-            start_text = args[1]
+            start_text = args[0]
     else:
         try:
             length = int(args[0])
@@ -745,23 +1587,60 @@ def bot_cmd_neuroshit(msg: Message):
         bot.send_message(chat_id, "Допустимая длина - от 100 до 500.")
         return
 
+    if start_text is None and neuro_buffer is not None:
+        result = neuro_buffer.get(length)
+        if result is not None:
+            bot.send_message(chat_id, result)
+            return
+    if start_text is None:
+        start_text = random.choice(string.ascii_letters)
+
+    reply_msg = bot.send_message(chat_id, "Думаю...")
+    shown_text = reply_msg.text
+    last_edit = time.monotonic()
+
+    def show(text: str):
+        """
+        Заменяет текст ответа, если он изменился.
+        """
+        nonlocal shown_text, last_edit
+        last_edit = time.monotonic()
+        if not text or text == shown_text:
+            return
+        try:
+            bot.edit_message_text(text, chat_id, reply_msg.message_id)
+            shown_text = text
+        except telebot.apihelper.ApiException:
+            log.debug("neuroshit edit failed", exc_info=True)
+
+    def show_partial(text: str):
+        """
+        Показывает уже сгенерированную часть, не чаще раза в ``NEURO_EDIT_INTERVAL`` секунд.
+        """
+        if time.monotonic() - last_edit >= config.NEURO_EDIT_INTERVAL:
+            show(text + "...")
+
     try:
-        result = run_neuroshit(length, start_text)
-    except subprocess.CalledProcessError as exc:
+        result = run_neuroshit(length, start_text, show_partial)
+    except sampler_pool.SamplerError as exc:
         result = f"Что-то пошло не так -_-\n" \
-                 f"{exc.stdout}"
+                 f"{exc}"
         log.error("neuroshit broken?!", exc_info=True)
-    except subprocess.TimeoutExpired:
-        result = f"Я думал слишком долго ~_~"
+    except subprocess.TimeoutExpired as exc:
+        if exc.output:
+            result = f"{exc.output}\n\nЯ думал слишком долго ~_~ Вот, что успел."
+        else:
+            result = f"Я думал слишком долго ~_~"
         log.warning("neuroshit timeout", exc_info=True)
     except:
         result = f"Произошло нечто ужасное. Кучка макак уже (не) в пути."
         log.warning("unknown neuroshit issue", exc_info=True)
-    bot.send_message(chat_id, result)
+    show(result)
 
 
 @bot.message_handler(commands=["vk_pic", ])
 @bot.channel_post_handler(commands=["vk_pic", ])
+@admitted("vk")
 def bot_cmd_vk_pic(msg: Message):
     """
     Посылает рандомную картинку из списка сообществ.
@@ -776,14 +1655,22 @@ def bot_cmd_vk_pic(msg: Message):
     if len(chat_states[chat_id].vk_groups) == 0:
         bot.send_message(chat_id, "Сначала настройте группы с помощью /config_vk")
         return
+    if breakers["vk"].is_open:
+        reply_unavailable(chat_id, breakers["vk"])
+        return
     bot.send_chat_action(chat_id, "upload_photo")
     chosen_group: vk_group.VkGroup = random.choice(chat_states[chat_id].vk_groups)
     log.debug(f"selected {chosen_group} as source")
-    response = vk_tools.get_all("wall.get", max_count=config.VK_ITEMS_PER_REQUEST, values={
-        "domain": chosen_group.url_name,
-        "fields": "attachments",
-        "version": VK_VER,
-    }, limit=config.VK_ITEMS_PER_REQUEST * 25)  # 275 постов по умолчанию
+    try:
+        response = vk_wall_flight.do(chosen_group.vk_id, lambda: breakers["vk"].call(
+            vk_tools.get_all, "wall.get", max_count=config.VK_ITEMS_PER_REQUEST, values={
+                "domain": chosen_group.url_name,
+                "fields": "attachments",
+                "version": VK_VER,
+            }, limit=config.VK_ITEMS_PER_REQUEST * 25))  # 275 постов по умолчанию
+    except circuit_breaker.CircuitOpenError:
+        reply_unavailable(chat_id, breakers["vk"])
+        return
     max_size_url = "ERROR"
     log.debug("items count: {}".format(len(response["items"])))
     chosen = False
@@ -867,6 +1754,26 @@ def bot_cmd_iqdb(msg: Message):
     bot.send_message(chat_id, out_msg, parse_mode="HTML")
 
 
+@bot.message_handler(commands=["sauce", ])
+@bot.channel_post_handler(commands=["sauce", ])
+def bot_cmd_sauce(msg: Message):
+    """
+    Входит в режим поиска соуса сразу в iqdb.org и whatanime.ga.
+
+    :param Message msg: сообщение
+    """
+    bot_all_messages(msg)
+    chat_id = msg.chat.id
+    if iqdb_disabled and whatanime_disabled:
+        bot.send_message(chat_id, "Модули iqdb.org и whatanime.ga отключены.")
+        return
+    chat_states[chat_id].state_name = chat_state.SAUCE
+    out_msg = "Вошел в режим <b>поиска соуса: iqdb.org + whatanime.ga</b>!\n" \
+              "Напиши /abort для выхода.\n\n" \
+              "Для поиска отправь картинку или <b>прямую</b> ссылку (должна начинаться с http/https)."
+    bot.send_message(chat_id, out_msg, parse_mode="HTML")
+
+
 def get_names(msg: Message) -> typing.Tuple[typing.List[str], int]:
     """
     Забирает список юзернеймов из сообщения и возвращает список имен и количество
@@ -956,27 +1863,51 @@ def bot_cmd_quote(msg: Message):
     :param Message msg: сообщение
     """
     bot_all_messages(msg)
-    quote = requests.get("https://tproger.ru/wp-content/plugins/citation-widget/get-quote.php").text
-    bot.send_message(msg.chat.id, f"<code>{quote}</code>", parse_mode="HTML")
+    quote, fresh = quotes.get()
+    if quote is None:
+        reply_unavailable(msg.chat.id, breakers["quote"])
+        return
+    stale_note = "" if fresh else "\n\n(сайт недоступен, повторяю из недавних)"
+    bot.send_message(msg.chat.id, f"<code>{quote}</code>{stale_note}", parse_mode="HTML")
 
 
+# noinspection PyBroadException
 @bot.message_handler(commands=["anek", ])
 @bot.channel_post_handler(commands=["anek", ])
+@admitted("anek")
 def bot_cmd_anek(msg: Message):
     """
-    Посылает рандомный анекдот с `baneks.ru`.
+    Посылает рандомный анекдот с `baneks.ru` из локальной базы (пока она пуста -- прямо с сайта).
+    Слова после команды -- поиск анекдота, содержащего их все.
 
     :param Message msg: сообщение
     """
     bot_all_messages(msg)
-    request = requests.get("https://baneks.ru/{}".format(random.randrange(1, 1142)))
-    request.encoding = "utf-8"
-    html_text = request.text
-
-    # Да, это парсинг регексами: сервер отдает данные без экранирования кавычек...
-    result = HTML_ANEK_REGEX.search(html_text)
-    out_msg = result.group(1) if result else "ERROR"
-    bot.send_message(msg.chat.id, f"<code>{out_msg}</code>", parse_mode="HTML")
+    chat_id = msg.chat.id
+    query = msg.text.split(" ", 1)[1].strip() if " " in msg.text else ""
+    if query:
+        if not len(aneks):
+            bot.send_message(chat_id, "Анекдоты еще загружаются, поиск заработает через пару минут.")
+            return
+        found = aneks.search(query)
+        if not found:
+            bot.send_message(chat_id, f"Не знаю анекдотов про «{query}».")
+            return
+        anek = random.choice(found)
+    else:
+        anek = aneks.random()
+    if anek is None:  # База еще пуста: загружаем с сайта напрямую
+        try:
+            anek = fetch_random_anek()
+        except circuit_breaker.CircuitOpenError:
+            reply_unavailable(chat_id, breakers["anek"])
+            return
+        except Exception:
+            log.info("anek live fetch fail:", exc_info=True)
+        if anek is None:
+            bot.send_message(chat_id, "Не смог загрузить анекдот, попробуй через пару минут.")
+            return
+    bot.send_message(chat_id, f"<code>{anek}</code>", parse_mode="HTML")
 
 
 @bot.inline_handler(lambda a: True)
@@ -1098,7 +2029,7 @@ def prepare_logger() -> logging.Logger:
 # noinspection PyBroadException
 def save_chat_states():
     """
-    Сохряняет состояние чатов и пользователей в ``.pkl``-файл.
+    Сохряняет состояние чатов, пользователей, кэш поиска и базу анекдотов в ``.pkl``-файл.
     """
     states_save_path = os.path.join(saves_path, "states.pkl")
     users_save_path = os.path.join(saves_path, "users.pkl")
@@ -1113,6 +2044,9 @@ def save_chat_states():
                 pickle.dump(chat_states, states_file, pickle.HIGHEST_PROTOCOL)
                 with open(users_save_path, "w+b") as users_file:
                     pickle.dump(users_dict, users_file, pickle.HIGHEST_PROTOCOL)
+                search_cache.save()
+                if aneks is not None:
+                    aneks.save()
                 log.info("...success!")
                 break
         except:
@@ -1121,6 +2055,29 @@ def save_chat_states():
             retry_count += 1
 
 
+def clean_tmp_dir(max_age: float) -> int:
+    """
+    Удаляет из ``tmp_path`` файлы старше ``max_age`` секунд,
+    например ``search_*``, ``thumb_*`` и ``prev_*``, оставшиеся от старых версий и падений.
+
+    :param float max_age: максимальный возраст файла в секундах
+    :return: кол-во удаленных файлов
+    :rtype: int
+    """
+    if not os.path.isdir(tmp_path):
+        return 0
+    removed = 0
+    now = time.time()
+    for entry in os.scandir(tmp_path):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            log.warning(f"can't remove {entry.path}", exc_info=True)
+    return removed
+
+
 # noinspection PyUnusedLocal
 def exit_handler(sig, frame):
     """
@@ -1128,6 +2085,10 @@ def exit_handler(sig, frame):
     """
     save_chat_states()
     bot.stop_polling()
+    if images is not None:
+        images.shutdown()
+    if neuro_pool is not None:
+        neuro_pool.shutdown()
     for file in messages_log_files.values():
         if not file.closed:
             file.close()
@@ -1162,11 +2123,13 @@ def main() -> int:
 
     log.info("-=-=-= NEW LAUNCH =-=-=-")
 
+    log.info(f"removed {clean_tmp_dir(config.TMP_MAX_AGE)} orphaned files from {tmp_path}")
+
     # Init inline queries
     try:
         log.info("inline init...")
         global soundboard_sounds
-        response = requests.get(config.SERVER_ADDRESS + "/index.json")
+        response = make_http_session().get(config.SERVER_ADDRESS + "/index.json")
         json_arr = response.json()
         for sound in json_arr:
             soundboard_sounds.append(InlineSound(sound))
@@ -1201,12 +2164,20 @@ def main() -> int:
     except:
         log.error("...failure, VK disabled!", exc_info=True)
 
+    # Init image processing pool
+    global images
+    images = image_pool.ImagePool(config.IMAGE_WORKERS, config.IMAGE_QUEUE_LIMIT, config.IMAGE_TIMEOUT,
+                                  preload=[iqdb_org.__name__, whatanime_ga.__name__, image_hash.__name__])
+    log.info(f"image pool: {config.IMAGE_WORKERS} workers, queue limit {config.IMAGE_QUEUE_LIMIT}")
+
     # Init whatanime.ga API
     try:
         log.info("whatanime init...")
         global whatanime
-        whatanime = whatanime_ga.WhatAnimeClient(config.WHATANIME_TOKEN)
+        whatanime = whatanime_ga.WhatAnimeClient(config.WHATANIME_TOKEN, images, make_http_session())
         log.info("...success! UID: {}".format(whatanime.user_id))
+        global whatanime_quota
+        whatanime_quota = quota.QuotaScheduler(whatanime.quota, whatanime.quota_ttl)
         global whatanime_disabled
         whatanime_disabled = False
     except:
@@ -1216,8 +2187,15 @@ def main() -> int:
     try:
         log.info("iqdb init...")
         global iqdb
-        iqdb = iqdb_org.IqdbClient()
-        log.info("...success! Boorus:\n{}".format(iqdb.boorus_status))
+        iqdb = iqdb_org.IqdbClient(config.IQDB_UPLOAD_MAX_SIDE, images, make_http_session())
+        try:
+            with open(os.path.join(saves_path, "iqdb_status.pkl"), "rb") as status_file:
+                iqdb.boorus_status, iqdb.status_updated = pickle.load(status_file)
+            log.info("...loaded saved boorus status:\n{}".format(iqdb.boorus_status))
+        except:
+            log.info("...no saved boorus status")
+        threading.Thread(target=refresh_iqdb_status, name="iqdb-status", daemon=True).start()
+        log.info("...success!")
         global iqdb_disabled
         iqdb_disabled = False
     except:
@@ -1226,18 +2204,31 @@ def main() -> int:
     # Init neuroshit
     try:
         log.info("neuroshit init...")
+        global neuro_pool
+        neuro_pool = make_neuro_pool()
+        neuro_pool.start()
         test_str = run_neuroshit(2, "b")
         log.info(f"...success! Test str: {test_str}")
         global neuroshit_disabled
         neuroshit_disabled = False
-    except subprocess.CalledProcessError as exc:
-        log.error(f"...failure, neuroshit disabled (procerr)!\n"
-                  f"stdout: {exc.stdout}\n"
-                  f"stderr: {exc.stderr}", exc_info=True)
+        if config.NEURO_BUFFER_SIZE > 0:
+            global neuro_buffer
+            neuro_buffer = sample_buffer.SampleBuffer(
+                lambda length: run_neuroshit(length, random.choice(string.ascii_letters)),
+                config.NEURO_BUFFER_LENGTHS, config.NEURO_BUFFER_SIZE,
+                is_idle=lambda: neuro_pool.idle == neuro_pool.size)
+            neuro_buffer.start()
+    except sampler_pool.SamplerError:
+        log.error(f"...failure, neuroshit disabled (procerr)!", exc_info=True)
     except subprocess.TimeoutExpired:
         log.error(f"...failure, neuroshit disabled (proctimeout)!", exc_info=True)
     except:
         log.error(f"...failure, neuroshit disabled (unknown)!", exc_info=True)
+    if neuroshit_disabled and neuro_pool is not None:
+        neuro_pool.shutdown()
+
+    # Prefetch /quote and /anek
+    quotes.start()
 
     # Load info from disk
     states_save_path = os.path.join(saves_path, "states.pkl")
@@ -1259,6 +2250,23 @@ def main() -> int:
             time.sleep(retry_count)  # Not a bug too
             retry_count += 1
 
+    try:
+        search_cache.load()
+    except:
+        log.error("search cache load failed, starting empty", exc_info=True)
+
+    global aneks
+    aneks = anek_corpus.AnekCorpus(os.path.join(saves_path, "aneks.pkl"), config.ANEK_KNOWN_MAX)
+    try:
+        aneks.load()
+        log.info(f"loaded {len(aneks)} aneks")
+    except FileNotFoundError:
+        log.info("no saved aneks, crawling from scratch")
+    except:
+        log.error("aneks load failed, crawling from scratch", exc_info=True)
+    anek_corpus.AnekCrawler(aneks, fetch_anek, config.ANEK_CRAWL_DELAY, config.ANEK_DISCOVER_AHEAD,
+                            config.ANEK_RECHECK).start()
+
     telebot.logger.setLevel(config.LOG_LEVEL)
     telebot.apihelper.proxy = {
         'http': config.PROXY,
@@ -3,22 +3,35 @@
 Модуль взаимодействия с https://iqdb.org
 """
 import re
+import time
 from enum import Enum
 from io import BytesIO
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 
 import requests
 from PIL import Image
 # noinspection PyProtectedMember
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+
+try:
+    from ..utils.image_pool import run_in_pool, to_rgb, NotAPictureError
+except ImportError:
+    from utils.image_pool import run_in_pool, to_rgb, NotAPictureError
 
 FAIL_COUNT_REGEX = re.compile(r".*?(\d+).*")
 FAIL_REASON_REGEX = re.compile(r".*Last reason: (.*)\)", re.DOTALL)
+TIMING_REGEX = re.compile(r"<p style=[\"']font-size: small;[\"']>.*?</p>", re.DOTALL)
+PAGES_START_REGEX = re.compile(r"<div[^>]*\bid=[\"']pages[\"']")
+
+# Дерево строится только для нужных элементов: остальная страница лишь токенизируется
+PAGES_STRAINER = SoupStrainer("div", attrs={"id": "pages"})
+STATUS_STRAINER = SoupStrainer("table", attrs={"style": "white-space: nowrap"})
 
 ENDPOINT: str = "https://iqdb.org"
-MAX_SIDE_RESOLUTION: int = 7500
 MAX_SIZE: int = 8388608  # in bytes
-# SUPPORTED_FORMATS: List = ["PNG", "JPEG", "GIF", ]
+SUPPORTED_FORMATS: List = ["PNG", "JPEG", "GIF", ]
+UPLOAD_MAX_SIDE: int = 800  # iqdb все равно сравнивает миниатюры
+UPLOAD_QUALITY: int = 90
 
 
 class MatchTypeEnum(Enum):
@@ -173,6 +186,146 @@ class IqdbBooru:
         return self.__str()
 
 
+def normalize_picture(picture: Union[bytes, bytearray, memoryview], max_side: int = UPLOAD_MAX_SIDE) -> bytes:
+    """
+    Готовит картинку к загрузке на iqdb.
+
+    Картинки поддерживаемого формата, что уже укладываются в ``max_side``, отправляются как есть.
+    Остальные уменьшаются до ``max_side`` по большей стороне и пережимаются в JPEG.
+
+    :param picture: содержимое картинки в памяти
+    :param int max_side: максимальный размер стороны
+    :return: картинка для загрузки
+    :rtype: bytes
+    """
+    try:
+        img: Image.Image = Image.open(BytesIO(picture))
+    except OSError as exc:
+        raise NotAPictureError() from exc
+    if img.format in SUPPORTED_FORMATS and max(img.size) <= max_side and len(picture) <= MAX_SIZE:
+        return bytes(picture)
+
+    img.draft("RGB", (max_side, max_side))  # JPEG декодируется сразу в меньшем разрешении
+    img.thumbnail((max_side, max_side), Image.BILINEAR)
+    img = to_rgb(img)
+    out = BytesIO()
+    img.save(out, "JPEG", quality=UPLOAD_QUALITY)
+    return out.getvalue()
+
+
+def parse_status(html: str) -> List[IqdbBooru]:
+    """
+    Разбирает страницу статуса бур (``?status=1``).
+
+    :param str html: страница
+    :return: статус обновления бур
+    :rtype: List[IqdbBooru]
+    """
+    soup = BeautifulSoup(html, "html.parser", parse_only=STATUS_STRAINER)
+    table_body: Tag = soup.find("table", attrs={
+        "style": "white-space: nowrap"
+    }).find("tbody")
+
+    result = []
+    for entry in table_body.find_all('tr'):
+        entry_strings = entry.find_all('td')
+        r_name = entry_strings[0].text
+        r_post_update = entry_strings[1].text
+        r_tag_update = entry_strings[2].text
+        r_latest_post = int(entry_strings[3].text)
+        update_failure_string: str = entry_strings[4].text
+        r_update_fail_count = None
+        r_update_fail_reason = None
+        if len(update_failure_string) > 0:
+            # noinspection PyBroadException
+            try:
+                r_update_fail_count = int(
+                    FAIL_COUNT_REGEX.search(update_failure_string).group(1)
+                )
+                r_update_fail_reason = FAIL_REASON_REGEX.search(update_failure_string) \
+                    .group(1).replace('\n', '')
+            except:
+                pass
+        booru_instance = IqdbBooru(
+            name=r_name,
+            post_update=r_post_update,
+            tag_update=r_tag_update,
+            latest_post=r_latest_post,
+            update_fail_count=r_update_fail_count,
+            update_fail_reason=r_update_fail_reason
+        )
+        result.append(booru_instance)
+    return result
+
+
+def parse_search_page(html: str) -> Tuple[Optional[str], List[IqdbResult]]:
+    """
+    Разбирает страницу с результатами поиска.
+
+    Вместо всей страницы в дерево разбирается только блок ``#pages``,
+    а строка со временем поиска вырезается регулярным выражением.
+
+    :param str html: страница
+    :return: строка со временем поиска И найденные результаты
+    :rtype: Tuple[Optional[str], List[IqdbResult]]
+    """
+    timing_match = TIMING_REGEX.search(html)
+    results_timing = BeautifulSoup(timing_match.group(0), "html.parser").text if timing_match else None
+
+    pages_start = PAGES_START_REGEX.search(html)
+    soup = BeautifulSoup(html[pages_start.start():] if pages_start else html, "html.parser",
+                         parse_only=PAGES_STRAINER)
+
+    result: List[IqdbResult] = []
+
+    results_boxes: Tag = soup.find("div", attrs={
+        "id": "pages",
+        "class": "pages",
+    })
+
+    for result_box in results_boxes.find_all('div'):  # Main matches
+        info_strings: List[Tag] = result_box.find('table') \
+            .find_all('tr')
+        match_type = info_strings[0].find('th').text
+        if match_type == MatchTypeEnum.SKIP.value:
+            continue  # Your image
+        if match_type == MatchTypeEnum.NO.value:
+            continue  # No relevant matches
+        r_match_type = match_type
+        links: Tag = info_strings[1].find('td')
+        source_link: str = links.find('a')['href']
+        r_source_link = 'http:' + source_link if source_link.startswith('//') else source_link
+        img_tag: Tag = links.find('a').find('img')
+        r_preview_link = ENDPOINT + img_tag['src']
+        r_tags = None
+        if img_tag.has_attr('title'):
+            if ',' in img_tag['title']:
+                split_char = ','
+            else:
+                split_char = ' '
+            # noinspection PyBroadException
+            try:
+                r_tags = img_tag['title'].split('Tags: ')[1].split(split_char)
+            except:
+                pass
+        res_and_rating = info_strings[3].find('td').text
+        r_resolution, r_rating = res_and_rating.split(' ')
+        r_similarity = info_strings[4].find('td').text.split('%')[0]
+
+        iqdbresult_instance = IqdbResult(
+            match_type=r_match_type,
+            preview_link=r_preview_link,
+            source_link=r_source_link,
+            resolution=r_resolution,
+            rating=r_rating,
+            similarity=r_similarity,
+            tags=r_tags
+        )
+        result.append(iqdbresult_instance)
+
+    return results_timing, result
+
+
 class IqdbClient:
     """
     Клиент для https://iqdb.org.
@@ -189,141 +342,72 @@ class IqdbClient:
 
     boorus_status: List[IqdbBooru] = None
     """
-    Статус обновления бур.
+    Статус обновления бур. ``None``, пока ``get_status`` ни разу не отработал.
     """
 
-    def __init__(self):
-        self.get_status()
+    status_updated: Optional[float] = None
+    """
+    Время (unix) последнего успешного обновления ``boorus_status``.
+    """
+
+    upload_max_side: int = UPLOAD_MAX_SIDE
+    """
+    Максимальный размер стороны загружаемой картинки.
+    """
+
+    image_pool = None
+    """
+    Пул процессов для обработки картинок (``utils.image_pool.ImagePool``) или ``None``.
+    """
+
+    session: requests.Session = None
+    """
+    HTTP-сессия с пулом keep-alive соединений.
+    """
+
+    def __init__(self, upload_max_side: int = UPLOAD_MAX_SIDE, image_pool=None,
+                 session: Optional[requests.Session] = None):
+        """
+        :param int upload_max_side: максимальный размер стороны загружаемой картинки
+        :param image_pool: пул процессов для обработки картинок; ``None`` -- обрабатывать в текущем потоке
+        :param session: HTTP-сессия; ``None`` -- создать новую
+        """
+        self.upload_max_side = upload_max_side
+        self.image_pool = image_pool
+        self.session = session if session is not None else requests.Session()
 
     def get_status(self):
         """
         Получает статус обновления бур.
+        Не вызывается при создании клиента: статус обновляется в фоне.
         """
-        response = requests.get(ENDPOINT, params={
+        response = self.session.get(ENDPOINT, params={
             "status": "1"
         })
+        response.raise_for_status()
         response.encoding = 'utf-8'
-        soup = BeautifulSoup(response.text, "html.parser")
-        table_body: Tag = soup.find("table", attrs={
-            "style": "white-space: nowrap"
-        }).find("tbody")
-
-        result = []
-        for entry in table_body.find_all('tr'):
-            entry_strings = entry.find_all('td')
-            r_name = entry_strings[0].text
-            r_post_update = entry_strings[1].text
-            r_tag_update = entry_strings[2].text
-            r_latest_post = int(entry_strings[3].text)
-            update_failure_string: str = entry_strings[4].text
-            r_update_fail_count = None
-            r_update_fail_reason = None
-            if len(update_failure_string) > 0:
-                # noinspection PyBroadException
-                try:
-                    r_update_fail_count = int(
-                        FAIL_COUNT_REGEX.search(update_failure_string).group(1)
-                    )
-                    r_update_fail_reason = FAIL_REASON_REGEX.search(update_failure_string) \
-                        .group(1).replace('\n', '')
-                except:
-                    pass
-            booru_instance = IqdbBooru(
-                name=r_name,
-                post_update=r_post_update,
-                tag_update=r_tag_update,
-                latest_post=r_latest_post,
-                update_fail_count=r_update_fail_count,
-                update_fail_reason=r_update_fail_reason
-            )
-            result.append(booru_instance)
-        self.boorus_status = result
-
-    def search(self, picture_path: str) -> List[IqdbResult]:
+        self.boorus_status = parse_status(response.text)
+        self.status_updated = time.time()
+
+    def search(self, picture: Union[bytes, bytearray, memoryview]) -> List[IqdbResult]:
         """
         Ищет арт на бурах.
 
-        Поддерживаются картинки:
-
-        * PNG, JPEG, GIF
-        * < 8192KB
-        * < 7500px по каждой стороне
+        Картинка предварительно уменьшается (см. :func:`normalize_picture`),
+        поэтому ограничения iqdb на размер и формат соблюдаются автоматически.
 
-        :param str picture_path: путь до картинки на диске
+        :param picture: содержимое картинки в памяти
         :return: ответ сервера
         :rtype: List[IqdbResult]
         """
-        with open(picture_path, mode="rb") as file:
-            try:
-                img: Image.Image = Image.open(file)
-            except OSError as exc:
-                raise IOError("file is not a picture") from exc
-            if img.height >= MAX_SIDE_RESOLUTION or img.width >= MAX_SIDE_RESOLUTION:
-                raise RuntimeError("image height or width is larger than 7500px")
-            out = BytesIO()
-            img.save(out, "PNG", optimize=True)  # Convert any image to supported format
-            if out.getbuffer().nbytes > MAX_SIZE:
-                raise RuntimeError("image is larger than 8MB")
-        # noinspection PyUnboundLocalVariable
-        response = requests.post(ENDPOINT, headers={
+        upload = run_in_pool(self.image_pool, normalize_picture, bytes(picture), self.upload_max_side)
+        response = self.session.post(ENDPOINT, headers={
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                           "Chrome/64.0.3253.3 Safari/537.36",
         }, files={
-            "file": out.getvalue(),
+            "file": upload,
         })
 
         response.encoding = 'utf-8'
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        self.results_timing: Tag = soup.find("p", attrs={
-            "style": "font-size: small;",
-        }).text
-
-        result: List[IqdbResult] = []
-
-        results_boxes: Tag = soup.find("div", attrs={
-            "id": "pages",
-            "class": "pages",
-        })
-
-        for result_box in results_boxes.find_all('div'):  # Main matches
-            info_strings: List[Tag] = result_box.find('table') \
-                .find_all('tr')
-            match_type = info_strings[0].find('th').text
-            if match_type == MatchTypeEnum.SKIP.value:
-                continue  # Your image
-            if match_type == MatchTypeEnum.NO.value:
-                continue  # No relevant matches
-            r_match_type = match_type
-            links: Tag = info_strings[1].find('td')
-            source_link: str = links.find('a')['href']
-            r_source_link = 'http:' + source_link if source_link.startswith('//') else source_link
-            img_tag: Tag = links.find('a').find('img')
-            r_preview_link = ENDPOINT + img_tag['src']
-            r_tags = None
-            if img_tag.has_attr('title'):
-                if ',' in img_tag['title']:
-                    split_char = ','
-                else:
-                    split_char = ' '
-                # noinspection PyBroadException
-                try:
-                    r_tags = img_tag['title'].split('Tags: ')[1].split(split_char)
-                except:
-                    pass
-            res_and_rating = info_strings[3].find('td').text
-            r_resolution, r_rating = res_and_rating.split(' ')
-            r_similarity = info_strings[4].find('td').text.split('%')[0]
-
-            iqdbresult_instance = IqdbResult(
-                match_type=r_match_type,
-                preview_link=r_preview_link,
-                source_link=r_source_link,
-                resolution=r_resolution,
-                rating=r_rating,
-                similarity=r_similarity,
-                tags=r_tags
-            )
-            result.append(iqdbresult_instance)
-
+        self.results_timing, result = parse_search_page(response.text)
         return result
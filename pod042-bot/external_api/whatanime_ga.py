@@ -2,9 +2,7 @@
 """
 Модуль взаимодействия с https://whatanime.ga.
 """
-import base64
 import json
-import os
 import typing
 from io import BytesIO
 from urllib.parse import quote
@@ -13,12 +11,13 @@ import requests
 from PIL import Image
 
 try:
-    from .. import config
+    from ..utils.image_pool import run_in_pool, to_rgb, NotAPictureError
 except ImportError:
-    import config
+    from utils.image_pool import run_in_pool, to_rgb, NotAPictureError
 
 ENDPOINT: str = "https://trace.moe"
-tmp_path = os.path.join(config.BOT_HOME, "tmp")
+SEARCH_MAX_SIDE: int = 640  # Кадры в индексе trace.moe не больше 640px, большее разрешение бесполезно
+SEARCH_QUALITY: int = 90
 
 
 class WhatAnimeResult:
@@ -107,16 +106,6 @@ class WhatAnimeResult:
     A token for generating preview
     """
 
-    thumb_path: str = None
-    """
-    Anime thumbnail path. ``None`` if ``load_thumbnail`` is not called.
-    """
-
-    preview_path: str = None
-    """
-    Anime video preview path. ``None`` if ``load_preview`` is not called.
-    """
-
     request_params: typing.Dict[str, typing.Any] = None
     """
     Параметры для запроса миниатюры и превью.
@@ -142,27 +131,78 @@ class WhatAnimeResult:
             "token": self.tokenthumb,
         }
 
-    def load_thumbnail(self):
+    def _media_url(self, script: str) -> str:
+        """
+        Собирает прямую ссылку на медиа результата.
+
+        :param str script: скрипт на сервере, ``thumbnail.php`` или ``preview.php``
+        :return: ссылка
+        :rtype: str
         """
-        Загружает миниатюру.
+        return requests.Request("GET", "{}/{}".format(ENDPOINT, script), params=self.request_params).prepare().url
+
+    @property
+    def thumbnail_url(self) -> str:
+        """
+        Прямая ссылка на миниатюру, её можно отдать Telegram без загрузки к себе.
+        """
+        return self._media_url("thumbnail.php")
+
+    @property
+    def preview_url(self) -> str:
+        """
+        Прямая ссылка на видео-превью, её можно отдать Telegram без загрузки к себе.
+        """
+        return self._media_url("preview.php")
+
+    def load_thumbnail(self, session: typing.Optional[requests.Session] = None) -> bytes:
         """
-        thumb_filename = os.path.join(tmp_path, "thumb_{}.jpg".format(self.filename))
-        with open(thumb_filename, mode="wb") as file:
-            response = requests.get("{}/thumbnail.php".format(ENDPOINT), params=self.request_params)
-            file.write(response.content)
-            self.thumb_path = os.path.realpath(file.name)
+        Загружает миниатюру в память.
 
-    def load_preview(self):
+        :param session: HTTP-сессия клиента; ``None`` -- отдельный запрос
+        :return: JPEG миниатюры
+        :rtype: bytes
         """
-        Загружает видео-превью.
+        response = (session or requests).get(self.thumbnail_url)
+        response.raise_for_status()
+        return response.content
 
+    def load_preview(self, session: typing.Optional[requests.Session] = None) -> bytes:
+        """
+        Загружает видео-превью в память.
+
+        :param session: HTTP-сессия клиента; ``None`` -- отдельный запрос
+        :return: MP4 превью
+        :rtype: bytes
         :except: при отсутствии превью
         """
-        prev_filename = os.path.join(tmp_path, "prev_{}.mp4".format(self.filename))
-        with open(prev_filename, mode="wb") as file:
-            response = requests.get("{}/preview.php".format(ENDPOINT), params=self.request_params)
-            file.write(response.content)
-            self.preview_path = os.path.realpath(file.name)
+        response = (session or requests).get(self.preview_url)
+        response.raise_for_status()
+        return response.content
+
+
+def build_payload(picture: typing.Union[bytes, bytearray, memoryview], max_side: int = SEARCH_MAX_SIDE) -> bytes:
+    """
+    Готовит картинку к поиску: уменьшает до ``max_side`` по большей стороне и пережимает в JPEG.
+
+    :param picture: содержимое картинки в памяти
+    :param int max_side: максимальный размер стороны
+    :return: JPEG для загрузки
+    :rtype: bytes
+    """
+    try:
+        img: Image.Image = Image.open(BytesIO(picture))
+    except OSError as exc:
+        raise NotAPictureError() from exc
+    if img.format == "JPEG" and max(img.size) <= max_side:
+        return bytes(picture)
+
+    img.draft("RGB", (max_side, max_side))  # JPEG декодируется сразу в меньшем разрешении
+    img.thumbnail((max_side, max_side), Image.BILINEAR)
+    img = to_rgb(img)
+    out = BytesIO()
+    img.save(out, "JPEG", quality=SEARCH_QUALITY)
+    return out.getvalue()
 
 
 class WhatAnimeClient:
@@ -209,11 +249,26 @@ class WhatAnimeClient:
     Время до обнуления ``now_quota``.
     """
 
-    def __init__(self, token: str):
+    image_pool = None
+    """
+    Пул процессов для обработки картинок (``utils.image_pool.ImagePool``) или ``None``.
+    """
+
+    session: requests.Session = None
+    """
+    HTTP-сессия с пулом keep-alive соединений.
+    Используется и для загрузки миниатюр и превью результатов.
+    """
+
+    def __init__(self, token: str, image_pool=None, session: typing.Optional[requests.Session] = None):
         """
         :param str token: токен для доступа на сервер
+        :param image_pool: пул процессов для обработки картинок; ``None`` -- обрабатывать в текущем потоке
+        :param session: HTTP-сессия; ``None`` -- создать новую
         """
         self.token = token
+        self.image_pool = image_pool
+        self.session = session if session is not None else requests.Session()
         self.load_info(token)
 
     def load_info(self, token: str):
@@ -222,37 +277,28 @@ class WhatAnimeClient:
 
         :param str token: токен для доступа на сервер
         """
-        response = requests.get("{}/api/me".format(ENDPOINT), params={
+        response = self.session.get("{}/api/me".format(ENDPOINT), params={
             "token": token,
         })
         self.__dict__.update(response.json())
 
-    def search(self, picture_path: str) -> typing.List[WhatAnimeResult]:
+    def search(self, picture: typing.Union[bytes, bytearray, memoryview]) -> typing.List[WhatAnimeResult]:
         """
-        Ищет аниме по скриншоту. Файлы, что в BASE64 > 1MB, не поддерживаются!
+        Ищет аниме по скриншоту.
+        Картинка уменьшается (см. :func:`build_payload`) и отправляется как multipart-файл, без BASE64.
 
-        :param str picture_path: путь до картинки на диске
+        :param picture: содержимое картинки в памяти
         :return: ответ сервера
         :rtype: WhatAnimeResult
         """
-        with open(picture_path, mode="rb") as file:
-            try:
-                img: Image.Image = Image.open(file)
-            except OSError as exc:
-                raise IOError("file is not a picture") from exc
-            out = BytesIO()
-            img.save(out, "JPEG", quality=90)
-        # Потратил 1.5 часа на отладку... оказалось, нужно просто написать "utf-8": к строке добавлялись b''
-        # noinspection PyUnboundLocalVariable
-        base64_encoded_image: str = str(base64.b64encode(out.getvalue()), "utf-8")
-        response = requests.post("{}/api/search".format(ENDPOINT), params={
+        payload = run_in_pool(self.image_pool, build_payload, bytes(picture))
+        response = self.session.post("{}/api/search".format(ENDPOINT), params={
             "token": self.token,
         }, headers={
-            "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                           "Chrome/64.0.3253.3 Safari/537.36",
-        }, data={
-            "image": "\'data:image/jpeg;base64," + base64_encoded_image + "\'",
+        }, files={
+            "image": ("image.jpg", payload, "image/jpeg"),
         })
         resp_json = response.json()
         self.now_quota = resp_json["quota"]
@@ -0,0 +1,97 @@
+-- Долгоживущий генератор для torch-rnn: модель загружается один раз,
+-- запросы приходят через stdin (см. utils/sampler_pool.py).
+-- Запускать из директории torch-rnn, чтобы нашелся LanguageModel.lua.
+require 'torch'
+require 'nn'
+
+require 'LanguageModel'
+
+
+local cmd = torch.CmdLine()
+cmd:option('-checkpoint', 'cv/checkpoint_4000.t7')
+cmd:option('-gpu', 0)
+cmd:option('-gpu_backend', 'cuda')
+local opt = cmd:parse(arg)
+
+
+local checkpoint = torch.load(opt.checkpoint)
+local model = checkpoint.model
+
+if opt.gpu >= 0 and opt.gpu_backend == 'cuda' then
+  require 'cutorch'
+  require 'cunn'
+  cutorch.setDevice(opt.gpu + 1)
+  model:cuda()
+elseif opt.gpu >= 0 and opt.gpu_backend == 'opencl' then
+  require 'cltorch'
+  require 'clnn'
+  cltorch.setDevice(opt.gpu + 1)
+  model:cl()
+end
+model:evaluate()
+
+
+local function reply(status, body)
+  io.stdout:write(status .. ' ' .. #body .. '\n' .. body)
+  io.stdout:flush()
+end
+
+local PART_SIZE = 16  -- Символов в одном куске потокового вывода
+
+
+-- То же, что LanguageModel:sample с sample = 1, но отдает текст кусками по мере генерации.
+local function stream_sample(length, start_text, temperature)
+  local pieces, part = {}, {}
+  model:resetStates()
+
+  local scores
+  if #start_text > 0 then
+    local x = model:encode_string(start_text):view(1, -1)
+    scores = model:forward(x)[{{}, {x:size(2), x:size(2)}}]
+    pieces[1] = start_text
+    reply('PART', start_text)
+    length = length - x:size(2)
+  else
+    local w = model.net:get(1).weight
+    scores = w.new(1, 1, model.vocab_size):fill(1)
+  end
+
+  for t = 1, length do
+    local probs = torch.div(scores, temperature):double():exp():squeeze()
+    probs:div(torch.sum(probs))
+    local next_char = torch.multinomial(probs, 1):view(1, 1)
+    local token = model.idx_to_token[next_char[1][1]]
+    pieces[#pieces + 1] = token
+    part[#part + 1] = token
+    if #part >= PART_SIZE or t == length then
+      reply('PART', table.concat(part))
+      part = {}
+    end
+    scores = model:forward(next_char)
+  end
+
+  model:resetStates()
+  return table.concat(pieces)
+end
+
+io.stdout:write('READY\n')
+io.stdout:flush()
+
+while true do
+  local header = io.stdin:read('*l')
+  if header == nil then
+    break
+  end
+  local length, temperature, text_size = header:match('^(%d+) (%S+) (%d+)$')
+  if length == nil then
+    reply('ERR', 'malformed request: ' .. header)
+  else
+    local start_text = io.stdin:read(tonumber(text_size)) or ''
+    local ok, result = pcall(stream_sample, tonumber(length), start_text, tonumber(temperature))
+    if ok then
+      reply('OK', result)
+    else
+      reply('ERR', tostring(result))
+    end
+  end
+end
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка генератора с тем же протоколом, что и ``sample_server.lua``.
+Позволяет проверить пропускную способность и задержки /neuroshit без torch.
+
+``standin_sampler.py [задержка загрузки] [задержка на символ]``, в секундах.
+"""
+import random
+import string
+import sys
+import time
+
+PART_SIZE = 16  # Символов в одном куске потокового вывода
+
+
+def main():
+    load_delay = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    char_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.002
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+
+    time.sleep(load_delay)  # "Загрузка модели"
+    stdout.write(b"READY\n")
+    stdout.flush()
+
+    for header in iter(stdin.readline, b""):
+        try:
+            length, temperature, text_size = header.split()
+            start_text = stdin.read(int(text_size))
+            length, temperature = int(length), float(temperature)
+        except ValueError:
+            body = f"malformed request: {header!r}".encode("utf-8")
+            stdout.write(b"ERR %d\n" % len(body) + body)
+            stdout.flush()
+            continue
+        alphabet = string.ascii_lowercase + " " * int(10 * temperature + 1)
+        body = start_text
+        stdout.write(b"PART %d\n" % len(start_text) + start_text)
+        stdout.flush()
+        length -= len(start_text.decode("utf-8", errors="replace"))  # Как в torch-rnn: длина вместе с началом
+        for generated in range(0, length, PART_SIZE):
+            count = min(PART_SIZE, length - generated)
+            part = "".join(random.choice(alphabet) for _ in range(count)).encode("utf-8")
+            time.sleep(char_delay * count)
+            body += part
+            stdout.write(b"PART %d\n" % len(part) + part)
+            stdout.flush()
+        stdout.write(b"OK %d\n" % len(body) + body)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
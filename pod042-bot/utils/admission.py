@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Допуск тяжелых команд: ограничение частоты по пользователям и чатам
+и честная очередь с ограниченным числом потоков на каждый класс команд.
+"""
+import logging
+import threading
+import time
+import typing
+from collections import OrderedDict, deque
+
+try:
+    from .quota import round_robin_position
+except ImportError:
+    from utils.quota import round_robin_position
+
+log = logging.getLogger(__name__)
+
+
+class RateLimitedError(RuntimeError):
+    """
+    Пользователь или чат превысил допустимую частоту запросов.
+    """
+
+    wait: float
+    """
+    Через сколько секунд можно повторить запрос.
+    """
+
+    def __init__(self, wait: float):
+        super().__init__(f"rate limited, retry in {wait:.0f}s")
+        self.wait = wait
+
+
+class QueueFullError(RuntimeError):
+    """
+    Очередь класса команд (или чата в ней) переполнена.
+    """
+
+
+class TokenBuckets:
+    """
+    Набор «ведер с жетонами» по ключам: ``burst`` запросов сразу, дальше ``rate`` запросов в секунду.
+    """
+
+    rate: float
+    """
+    Скорость пополнения, жетонов в секунду.
+    """
+
+    burst: int
+    """
+    Емкость ведра.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        """
+        :param float rate: скорость пополнения, жетонов в секунду
+        :param int burst: емкость ведра
+        :param int max_keys: после скольких ключей забывать полные ведра
+        """
+        self.rate = rate
+        self.burst = burst
+        self._max_keys = max_keys
+        self._buckets: typing.Dict[typing.Hashable, typing.Tuple[float, float]] = {}
+
+    def _tokens(self, key: typing.Hashable, now: float) -> float:
+        tokens, stamp = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - stamp) * self.rate)
+
+    def wait(self, key: typing.Hashable) -> float:
+        """
+        Сколько ждать до следующего жетона, ничего не списывая. Не потокобезопасно.
+
+        :param key: ключ
+        :return: 0, если жетон есть, иначе ожидание в секундах
+        :rtype: float
+        """
+        tokens = self._tokens(key, time.monotonic())
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key: typing.Hashable):
+        """
+        Списывает жетон (проверка -- через :meth:`wait`). Не потокобезопасно.
+
+        :param key: ключ
+        """
+        now = time.monotonic()
+        self._buckets[key] = (self._tokens(key, now) - 1, now)
+        if len(self._buckets) > self._max_keys:
+            for full_key in [other for other in self._buckets if self._tokens(other, now) >= self.burst]:
+                del self._buckets[full_key]
+
+
+class FairExecutor:
+    """
+    Ограниченный пул потоков с очередью по чатам: задачи выпускаются по одной от каждого чата за круг,
+    поэтому один активный чат не задерживает остальных.
+    """
+
+    name: str
+    """
+    Название класса команд.
+    """
+
+    workers: int
+    """
+    Количество потоков (одновременно выполняемых задач).
+    """
+
+    max_queued: int
+    """
+    Максимум задач в очереди.
+    """
+
+    max_queued_per_chat: int
+    """
+    Максимум задач в очереди от одного чата.
+    """
+
+    def __init__(self, name: str, workers: int, max_queued: int, max_queued_per_chat: int):
+        """
+        :param str name: название класса команд
+        :param int workers: количество потоков
+        :param int max_queued: максимум задач в очереди
+        :param int max_queued_per_chat: максимум задач в очереди от одного чата
+        """
+        self.name = name
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_queued_per_chat = max_queued_per_chat
+        self._queues: typing.Dict[typing.Hashable, typing.Deque[typing.Tuple[typing.Callable, tuple]]] = \
+            OrderedDict()
+        self._queued = 0
+        self._active = 0
+        self._avg_duration = 0.0  # Скользящее среднее времени задачи, для оценки ожидания
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, chat_id: typing.Hashable, func: typing.Callable, *args) -> typing.Tuple[int, float]:
+        """
+        Ставит ``func(*args)`` в очередь чата.
+
+        :param chat_id: ID чата
+        :param func: задача
+        :param args: аргументы
+        :return: сколько задач (включая уже выполняемые) должно закончиться или начаться раньше
+                 И примерное ожидание начала в секундах (0, пока среднее время задачи неизвестно);
+                 (0, 0) -- начнется сразу
+        :rtype: typing.Tuple[int, float]
+        :raise QueueFullError: очередь или очередь чата переполнена
+        """
+        with self._cond:
+            if self._queued >= self.max_queued \
+                    or len(self._queues.get(chat_id, ())) >= self.max_queued_per_chat:
+                raise QueueFullError(f"{self.name} queue is full")
+            ahead, wait = 0, 0.0
+            if self._active + self._queued >= self.workers:
+                ahead = self._active + round_robin_position(self._queues, chat_id)
+                # Задача начнется, когда закончатся все, кроме (workers - 1) из тех, что впереди
+                wait = (ahead - self.workers + 1) / self.workers * self._avg_duration
+            self._queues.setdefault(chat_id, deque()).append((func, args))
+            self._queued += 1
+            self._cond.notify()
+            return ahead, wait
+
+    def __str__(self):
+        return f"{self.name}: {self._active}/{self.workers}, в очереди {self._queued}"
+
+    def _work(self):
+        """
+        Выполняет задачи, каждый раз беря следующий чат по кругу.
+        """
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                chat_id, chat_queue = next(iter(self._queues.items()))
+                func, args = chat_queue.popleft()
+                del self._queues[chat_id]
+                if chat_queue:
+                    self._queues[chat_id] = chat_queue  # В конец круга
+                self._queued -= 1
+                self._active += 1
+            started = time.monotonic()
+            # noinspection PyBroadException
+            try:
+                func(*args)
+            except Exception:
+                log.error(f"{self.name} task failed", exc_info=True)
+            finally:
+                duration = time.monotonic() - started
+                with self._cond:
+                    self._active -= 1
+                    self._avg_duration = duration if not self._avg_duration \
+                        else 0.8 * self._avg_duration + 0.2 * duration
+
+
+class Admission:
+    """
+    Допуск команд: сначала частота по пользователю и чату, затем очередь класса команд.
+    """
+
+    executors: typing.Dict[str, FairExecutor]
+    """
+    Очереди классов команд.
+    название класса <-> FairExecutor
+    """
+
+    def __init__(self, user_rate: float, user_burst: int, chat_rate: float, chat_burst: int):
+        """
+        :param float user_rate: запросов в секунду от пользователя
+        :param int user_burst: запросов подряд от пользователя
+        :param float chat_rate: запросов в секунду от чата
+        :param int chat_burst: запросов подряд от чата
+        """
+        self._users = TokenBuckets(user_rate, user_burst)
+        self._chats = TokenBuckets(chat_rate, chat_burst)
+        self._lock = threading.Lock()
+        self.executors = {}
+
+    def add_class(self, name: str, workers: int, max_queued: int, max_queued_per_chat: int):
+        """
+        Добавляет класс команд со своим пулом потоков.
+
+        :param str name: название класса команд
+        :param int workers: количество потоков
+        :param int max_queued: максимум задач в очереди
+        :param int max_queued_per_chat: максимум задач в очереди от одного чата
+        """
+        self.executors[name] = FairExecutor(name, workers, max_queued, max_queued_per_chat)
+
+    def submit(self, command_class: str, chat_id: typing.Hashable, user_id: typing.Optional[typing.Hashable],
+               func: typing.Callable, *args) -> typing.Tuple[int, float]:
+        """
+        Проверяет частоту запросов и ставит задачу в очередь класса команд.
+
+        :param str command_class: название класса команд
+        :param chat_id: ID чата
+        :param user_id: ID пользователя или ``None`` (каналы)
+        :param func: задача
+        :param args: аргументы
+        :return: сколько задач раньше И примерное ожидание в секундах (см. :meth:`FairExecutor.submit`)
+        :rtype: typing.Tuple[int, float]
+        :raise RateLimitedError: слишком частые запросы
+        :raise QueueFullError: очередь переполнена
+        """
+        with self._lock:
+            wait = self._chats.wait(chat_id)
+            if user_id is not None:
+                wait = max(wait, self._users.wait(user_id))
+            if wait > 0:
+                raise RateLimitedError(wait)
+            queued = self.executors[command_class].submit(chat_id, func, *args)
+            self._chats.take(chat_id)
+            if user_id is not None:
+                self._users.take(user_id)
+            return queued
+
+    def __str__(self):
+        return ", ".join(str(executor) for executor in self.executors.values())
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная база анекдотов с поиском по словам и фоновое пополнение с сайта.
+"""
+import logging
+import os
+import pickle
+import random
+import re
+import threading
+import time
+import typing
+
+log = logging.getLogger(__name__)
+
+WORD_REGEX = re.compile(r"\w+")
+
+
+def words(text: str) -> typing.Set[str]:
+    """
+    Разбивает текст на слова для индекса.
+
+    :param str text: текст
+    :return: слова в нижнем регистре, ``ё`` заменена на ``е``
+    :rtype: typing.Set[str]
+    """
+    return set(WORD_REGEX.findall(text.lower().replace("ё", "е")))
+
+
+class AnekCorpus:
+    """
+    Анекдоты по номерам страниц с индексом слов.
+    На диске хранятся только тексты; индекс строится при загрузке.
+    """
+
+    path: str
+    """
+    Путь до ``.pkl``-файла базы.
+    """
+
+    max_id: int
+    """
+    Наибольший известный номер анекдота.
+    """
+
+    def __init__(self, path: str, max_id: int = 0):
+        """
+        :param str path: путь до ``.pkl``-файла базы
+        :param int max_id: наибольший заранее известный номер анекдота
+        """
+        self.path = path
+        self.max_id = max_id
+        self._texts: typing.Dict[int, str] = {}
+        self._ids: typing.List[int] = []
+        self._missing: typing.Set[int] = set()
+        self._index: typing.Dict[str, typing.Set[int]] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # Сохранения идут по одному: временный файл у них общий
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, anek_id: int):
+        return anek_id in self._texts or anek_id in self._missing
+
+    def add(self, anek_id: int, text: typing.Optional[str]):
+        """
+        Сохраняет анекдот; ``None`` -- страница пуста, больше ее не загружать.
+
+        :param int anek_id: номер анекдота
+        :param text: текст или ``None``
+        """
+        with self._lock:
+            if text is None:
+                self._missing.add(anek_id)
+                return
+            self.max_id = max(self.max_id, anek_id)
+            if anek_id not in self._texts:
+                self._ids.append(anek_id)
+            self._texts[anek_id] = text
+            for word in words(text):
+                self._index.setdefault(word, set()).add(anek_id)
+
+    def random(self) -> typing.Optional[str]:
+        """
+        Выбирает случайный анекдот, все равновероятны.
+
+        :return: текст или ``None``, если база пуста
+        :rtype: typing.Optional[str]
+        """
+        with self._lock:
+            return self._texts[random.choice(self._ids)] if self._ids else None
+
+    def search(self, query: str) -> typing.List[str]:
+        """
+        Ищет анекдоты, содержащие все слова запроса.
+
+        :param str query: запрос
+        :return: найденные тексты
+        :rtype: typing.List[str]
+        """
+        query_words = words(query)
+        if not query_words:
+            return []
+        with self._lock:
+            found = set.intersection(*(self._index.get(word, set()) for word in query_words))
+            return [self._texts[anek_id] for anek_id in sorted(found)]
+
+    def load(self):
+        """
+        Загружает базу с диска и строит индекс.
+        """
+        with open(self.path, "rb") as corpus_file:
+            saved = pickle.load(corpus_file)
+        for anek_id, text in saved["texts"].items():
+            self.add(anek_id, text)
+        for anek_id in saved["missing"]:
+            self.add(anek_id, None)
+        self.max_id = max(self.max_id, saved["max_id"])
+
+    def save(self):
+        """
+        Сохраняет базу на диск атомарно.
+        Одновременные вызовы выполняются по очереди, поиск при этом не блокируется.
+        """
+        with self._save_lock:
+            with self._lock:
+                saved = {"texts": dict(self._texts), "missing": set(self._missing), "max_id": self.max_id}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w+b") as corpus_file:
+                pickle.dump(saved, corpus_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+
+
+class AnekCrawler:
+    """
+    Медленно заполняет базу: сначала пропущенные номера до ``max_id``, затем пробует номера за ним.
+    Если ``discover_ahead`` номеров подряд за ``max_id`` пусты, новые проверяются через ``recheck`` секунд.
+    """
+
+    def __init__(self, corpus: AnekCorpus, fetch: typing.Callable[[int], typing.Optional[str]],
+                 delay: float, discover_ahead: int, recheck: float, save_every: int = 50):
+        """
+        :param AnekCorpus corpus: база
+        :param fetch: загружает анекдот по номеру; ``None`` -- страница пуста
+        :param float delay: пауза между запросами в секундах
+        :param int discover_ahead: сколько номеров за ``max_id`` пробовать
+        :param float recheck: пауза перед повторным поиском новых анекдотов в секундах
+        :param int save_every: сохранять базу после стольких новых анекдотов
+        """
+        self.corpus = corpus
+        self._fetch = fetch
+        self._delay = delay
+        self._discover_ahead = discover_ahead
+        self._recheck = recheck
+        self._save_every = save_every
+
+    def start(self):
+        """
+        Запускает фоновое пополнение.
+        """
+        threading.Thread(target=self._crawl, name="anek-crawler", daemon=True).start()
+
+    def _next_id(self) -> typing.Optional[int]:
+        """
+        Следующий номер для загрузки: пропущенный до ``max_id`` или первый за ним.
+        """
+        for anek_id in range(1, self.corpus.max_id + 1):
+            if anek_id not in self.corpus:
+                return anek_id
+        return None
+
+    # noinspection PyBroadException
+    def _crawl(self):
+        """
+        Загружает по одному анекдоту раз в ``delay`` секунд.
+        """
+        added = 0
+        misses_ahead = 0
+        delay = self._delay
+        while True:
+            anek_id = self._next_id()
+            discovering = anek_id is None
+            if discovering:
+                anek_id = self.corpus.max_id + 1 + misses_ahead
+            try:
+                text = self._fetch(anek_id)
+            except Exception:
+                log.info(f"anek {anek_id} fetch failed, retrying in {delay}s", exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, self._recheck)
+                continue
+            delay = self._delay
+
+            if text is None and discovering:
+                misses_ahead += 1
+                if misses_ahead >= self._discover_ahead:
+                    log.info(f"no aneks after #{self.corpus.max_id}, rechecking later")
+                    misses_ahead = 0
+                    time.sleep(self._recheck)
+                    continue
+            else:
+                misses_ahead = 0
+                self.corpus.add(anek_id, text)
+                if text is not None:  # Пустая страница не считается новым анекдотом
+                    added += 1
+                    if added % self._save_every == 0:
+                        self.corpus.save()
+            time.sleep(self._delay)
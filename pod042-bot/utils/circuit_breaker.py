@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Предохранитель (circuit breaker) для внешних сервисов.
+"""
+import threading
+import time
+import typing
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Сервис временно отключен предохранителем.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} is temporarily unavailable")
+
+
+class CircuitBreaker:
+    """
+    Считает ошибки и слишком медленные вызовы в скользящем окне.
+    При превышении доли ошибок размыкается: вызовы сразу падают с :class:`CircuitOpenError`.
+    Через ``open_seconds`` пропускает один пробный вызов (half-open) и по его итогу замыкается или размыкается снова.
+    """
+
+    name: str
+    """
+    Название сервиса.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 slow_call: float = 15, open_seconds: float = 60,
+                 excluded: typing.Tuple[typing.Type[BaseException], ...] = ()):
+        """
+        :param str name: название сервиса
+        :param int window: кол-во последних вызовов для подсчета доли ошибок
+        :param int min_calls: минимальное кол-во вызовов в окне для размыкания
+        :param float failure_rate: доля ошибок, при которой цепь размыкается
+        :param float slow_call: вызов дольше стольких секунд считается ошибкой
+        :param float open_seconds: сколько секунд цепь остается разомкнутой
+        :param excluded: исключения, которые не говорят о состоянии сервиса (например, плохой ввод);
+                         такие вызовы не считаются ни успехом, ни ошибкой
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.excluded = excluded
+        self._outcomes: typing.Deque[bool] = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """
+        Текущее состояние: ``closed``, ``open`` или ``half-open``.
+        """
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    @property
+    def is_open(self) -> bool:
+        """
+        ``True``, если вызовы сейчас отклоняются без попытки.
+        """
+        return self.state == OPEN
+
+    def allow(self) -> bool:
+        """
+        Пропустит ли :meth:`call` вызов прямо сейчас. Ничего не занимает:
+        полезно, чтобы не тратить квоту или очередь на вызов, который все равно будет отклонен.
+
+        :return: ``True``, если цепь замкнута или пробный вызов свободен
+        :rtype: bool
+        """
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return state == CLOSED or (state == HALF_OPEN and not self._probing)
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def _acquire(self) -> bool:
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def _release(self):
+        """
+        Освобождает пробный вызов, ничего не записывая.
+        """
+        with self._lock:
+            self._probing = False
+
+    def _record(self, success: bool):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._state = OPEN
+                    self._opened_at = time.monotonic()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def call(self, func: typing.Callable, *args, **kwargs) -> typing.Any:
+        """
+        Вызывает ``func`` через предохранитель.
+
+        :param func: функция, обращающаяся к сервису
+        :return: результат ``func``
+        :raise CircuitOpenError: цепь разомкнута
+        """
+        if not self._acquire():
+            raise CircuitOpenError(self.name)
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except self.excluded:
+            self._release()  # Сервис тут ни при чем: ни успех, ни ошибка
+            raise
+        except Exception:
+            self._record(False)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        self._record(time.monotonic() - started <= self.slow_call)
+        return result
+
+    def __str(self) -> str:
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            failures = self._outcomes.count(False)
+            total = len(self._outcomes)
+        return f"{self.name}: {state} ({failures}/{total} ошибок)"
+
+    def __str__(self) -> str:
+        return self.__str()
+
+    def __repr__(self) -> str:
+        return self.__str()
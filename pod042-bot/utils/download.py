@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковая загрузка файлов с ограничением размера.
+"""
+import time
+import typing
+
+import requests
+
+CHUNK_SIZE: int = 65536  # in bytes
+
+
+class FileTooLargeError(RuntimeError):
+    """
+    Размер файла превышает допустимый.
+    """
+
+    size: typing.Optional[int]
+    """
+    Известный размер файла (из ``Content-Length``) или ``None``.
+    """
+
+    def __init__(self, max_size: int, size: typing.Optional[int] = None):
+        self.size = size
+        super().__init__(f"file is larger than {max_size} bytes")
+
+
+class DownloadTooSlowError(RuntimeError):
+    """
+    Скорость загрузки ниже допустимой.
+    """
+
+
+def stream_download(session: requests.Session, url: str, max_size: int,
+                    timeout: typing.Tuple[float, float] = (4, 4),
+                    min_speed: int = 0, grace_period: float = 3,
+                    max_resumes: int = 2, proxies: typing.Optional[dict] = None,
+                    progress: typing.Optional[typing.Callable[[int, typing.Optional[int], float], None]] = None
+                    ) -> bytes:
+    """
+    Загружает файл по частям, прерываясь при превышении размера.
+
+    Если сервер сообщает ``Content-Length``, размер проверяется до чтения тела.
+    При обрыве соединения загрузка продолжается с помощью ``Range``, если сервер это поддерживает.
+
+    :param requests.Session session: сессия для запросов
+    :param str url: адрес файла
+    :param int max_size: максимальный размер в байтах
+    :param timeout: таймауты (подключение, чтение) в секундах
+    :param int min_speed: минимальная средняя скорость в байт/с после ``grace_period``; 0 -- без ограничения
+    :param float grace_period: время в секундах, в течение которого скорость не проверяется
+    :param int max_resumes: сколько раз можно продолжить оборванную загрузку
+    :param proxies: прокси для ``requests``
+    :param progress: вызывается после каждой части с (загружено байт, всего байт или ``None``, байт/с)
+    :return: содержимое файла
+    :rtype: bytes
+    :raise FileTooLargeError: файл больше ``max_size``
+    :raise DownloadTooSlowError: скорость ниже ``min_speed``
+    """
+    data = bytearray()
+    total: typing.Optional[int] = None
+    accepts_ranges: typing.Optional[bool] = None  # По первому ответу: ответы на Range могут не повторять заголовок
+    resumes = 0
+    started = time.monotonic()
+    while True:
+        headers = {"Range": f"bytes={len(data)}-"} if data else {}
+        response = None
+        try:
+            response = session.get(url, headers=headers, timeout=timeout, stream=True, proxies=proxies)
+            response.raise_for_status()
+            if accepts_ranges is None:
+                accepts_ranges = response.headers.get("Accept-Ranges") == "bytes"
+            if data and response.status_code != 206:  # Range не поддерживается, начинаем заново
+                data.clear()
+            length = response.headers.get("Content-Length")
+            if length is not None and length.isdigit():
+                total = len(data) + int(length)
+                if total > max_size:
+                    raise FileTooLargeError(max_size, total)
+
+            for chunk in response.iter_content(CHUNK_SIZE):
+                data += chunk
+                if len(data) > max_size:
+                    raise FileTooLargeError(max_size)
+                elapsed = time.monotonic() - started
+                speed = len(data) / elapsed if elapsed > 0 else 0.0
+                if min_speed and elapsed > grace_period and speed < min_speed:
+                    raise DownloadTooSlowError(f"download speed {speed:.0f} B/s is below {min_speed} B/s")
+                if progress is not None:
+                    progress(len(data), total, speed)
+            return bytes(data)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if not accepts_ranges or resumes >= max_resumes or not data:
+                raise
+            resumes += 1
+        finally:
+            if response is not None:
+                response.close()
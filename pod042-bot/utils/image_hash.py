@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Перцептивные хеши картинок и поиск похожих по расстоянию Хэмминга.
+"""
+import typing
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+try:
+    from .image_pool import NotAPictureError
+except ImportError:
+    from utils.image_pool import NotAPictureError
+
+HASH_SIZE: int = 8
+"""
+Сторона хеша: ``HASH_SIZE ** 2`` бит.
+"""
+
+
+def hamming(a: int, b: int) -> int:
+    """
+    Расстояние Хэмминга между двумя хешами.
+
+    :param int a: первый хеш
+    :param int b: второй хеш
+    :return: количество различающихся бит
+    :rtype: int
+    """
+    return bin(a ^ b).count("1")
+
+
+def dhash(img: Image.Image, size: int = HASH_SIZE) -> int:
+    """
+    Считает difference hash: знаки горизонтальных градиентов уменьшенной серой картинки.
+
+    :param Image.Image img: картинка
+    :param int size: сторона хеша
+    :return: хеш из ``size ** 2`` бит
+    :rtype: int
+    """
+    small = img.convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = numpy.asarray(small, dtype=numpy.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(numpy.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash_bytes(data: typing.Union[bytes, bytearray, memoryview], size: int = HASH_SIZE) -> int:
+    """
+    Считает difference hash картинки в памяти.
+    Для JPEG декодирует сразу в уменьшенном разрешении (``Image.draft``).
+
+    :param data: содержимое картинки
+    :param int size: сторона хеша
+    :return: хеш из ``size ** 2`` бит
+    :rtype: int
+    :raise NotAPictureError: данные не являются картинкой
+    """
+    try:
+        img: Image.Image = Image.open(BytesIO(data))
+    except OSError as exc:
+        raise NotAPictureError() from exc
+    img.draft("L", (size * 8, size * 8))
+    return dhash(img, size)
+
+
+class BKTree:
+    """
+    BK-дерево для поиска хешей в пределах заданного расстояния Хэмминга.
+
+    Узел: ``[хеш, значение, {расстояние: дочерний узел}]``.
+    """
+
+    def __init__(self):
+        self._root: typing.Optional[list] = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, item_hash: int, value: typing.Any):
+        """
+        Добавляет хеш со связанным значением.
+
+        :param int item_hash: хеш
+        :param value: значение
+        """
+        self._size += 1
+        if self._root is None:
+            self._root = [item_hash, value, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(item_hash, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [item_hash, value, {}]
+                return
+            node = child
+
+    def find(self, item_hash: int, max_distance: int) -> typing.List[typing.Tuple[int, typing.Any]]:
+        """
+        Ищет все значения, хеш которых отличается не больше чем на ``max_distance`` бит.
+
+        :param int item_hash: искомый хеш
+        :param int max_distance: максимальное расстояние Хэмминга
+        :return: пары (расстояние, значение), по возрастанию расстояния
+        :rtype: typing.List[typing.Tuple[int, typing.Any]]
+        """
+        result = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(item_hash, node[0])
+            if distance <= max_distance:
+                result.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        result.sort(key=lambda pair: pair[0])
+        return result
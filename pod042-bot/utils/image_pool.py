@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Пул процессов для тяжелой обработки картинок (Pillow держит GIL).
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import threading
+import typing
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+class NotAPictureError(IOError):
+    """
+    Данные не являются картинкой.
+    """
+
+    def __init__(self, message: str = "file is not a picture"):
+        # Сообщение -- аргумент: исключение возвращается из процесса пула через pickle, а тот вызывает cls(*args)
+        super().__init__(message)
+
+
+class PoolBusyError(RuntimeError):
+    """
+    Очередь пула переполнена.
+    """
+
+
+class PoolTimeoutError(TimeoutError):
+    """
+    Обработка в пуле не уложилась в ``timeout``.
+    """
+
+
+def to_rgb(img: Image.Image, background: typing.Tuple[int, int, int] = (255, 255, 255)) -> Image.Image:
+    """
+    Приводит картинку к RGB/L для JPEG, накладывая прозрачные участки на фон.
+    Без этого прозрачный фон после ``thumbnail`` становится черным.
+
+    :param img: картинка
+    :param background: цвет фона
+    :return: картинка в режиме ``RGB`` или ``L``
+    """
+    if img.mode in ("RGB", "L"):
+        return img
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        flat = Image.new("RGBA", img.size, background + (255,))
+        img = Image.alpha_composite(flat, img)
+    return img.convert("RGB")
+
+
+class ImagePool:
+    """
+    Ограниченный пул процессов: байты на вход, байты (или другой pickle-совместимый результат) на выход.
+
+    Функции должны быть объявлены на уровне модуля, чтобы их можно было передать в процесс,
+    а их модули -- импортироваться без побочных эффектов (см. ``preload``).
+    """
+
+    max_workers: int
+    """
+    Количество процессов.
+    """
+
+    max_pending: int
+    """
+    Максимальное количество задач в работе и в очереди.
+    """
+
+    timeout: float
+    """
+    Время ожидания результата в секундах.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, timeout: float, preload: typing.Iterable[str] = ()):
+        """
+        :param int max_workers: количество процессов
+        :param int max_pending: максимальное количество задач в работе и в очереди
+        :param float timeout: время ожидания результата в секундах
+        :param preload: модули с функциями для пула, загружаемые в forkserver заранее
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pending = 0
+        self._lock = threading.Lock()
+        # forkserver: процессы порождаются из отдельного однопоточного сервера, а не из многопоточного бота,
+        # поэтому пул можно безопасно пересоздать в любой момент
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(list(preload))
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(self.max_workers, mp_context=self._context)
+
+    def _rebuild(self, broken: concurrent.futures.ProcessPoolExecutor):
+        """
+        Заменяет сломанный пул новым (если его еще не заменил другой поток).
+        """
+        with self._lock:
+            if self._executor is broken:
+                log.warning("image pool is broken (worker died?), recreating it")
+                self._executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество задач в работе и в очереди.
+        """
+        return self._pending
+
+    def run(self, func: typing.Callable, *args) -> typing.Any:
+        """
+        Выполняет ``func(*args)`` в пуле и ждет результата.
+        Если процесс пула умер, пул пересоздается и задача повторяется один раз.
+
+        :param func: функция уровня модуля
+        :param args: pickle-совместимые аргументы
+        :return: результат ``func``
+        :raise PoolBusyError: очередь переполнена
+        :raise PoolTimeoutError: результат не получен за ``timeout`` секунд
+        :raise BrokenProcessPool: процесс умер и при повторе
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PoolBusyError("image processing queue is full, try again later")
+            self._pending += 1
+        release_now = True
+        try:
+            for attempt in range(2):
+                executor = self._executor
+                future = None
+                try:
+                    future = executor.submit(func, *args)
+                    return future.result(self.timeout)
+                except BrokenProcessPool:
+                    if attempt:
+                        raise
+                    self._rebuild(executor)
+                except concurrent.futures.TimeoutError as exc:
+                    if not future.cancel():
+                        # Задача еще выполняется: место в очереди освободится, когда она закончится
+                        release_now = False
+                        future.add_done_callback(lambda _: self._release())
+                    raise PoolTimeoutError("image processing took too long") from exc
+        finally:
+            if release_now:
+                self._release()
+
+    def shutdown(self):
+        """
+        Останавливает процессы.
+        """
+        self._executor.shutdown(wait=False)
+
+
+def run_in_pool(pool: typing.Optional[ImagePool], func: typing.Callable, *args) -> typing.Any:
+    """
+    Выполняет ``func(*args)`` в пуле, либо в текущем потоке, если пула нет.
+
+    :param pool: пул или ``None``
+    :param func: функция уровня модуля
+    :param args: аргументы
+    :return: результат ``func``
+    """
+    if pool is None:
+        return func(*args)
+    return pool.run(func, *args)
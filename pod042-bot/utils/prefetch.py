@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Фоновая предзагрузка контента из внешних источников (цитаты, анекдоты).
+"""
+import logging
+import random
+import threading
+import time
+import typing
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Держит небольшой запас свежих элементов и пополняет его в фоне.
+    Выданные элементы запоминаются: если источник недоступен, отдается один из недавних.
+    """
+
+    name: str
+    """
+    Название источника.
+    """
+
+    size: int
+    """
+    Размер запаса свежих элементов.
+    """
+
+    def __init__(self, name: str, fetch: typing.Callable[[], str], size: int, recent_size: int,
+                 max_delay: float = 300):
+        """
+        :param str name: название источника
+        :param fetch: загружает один элемент
+        :param int size: размер запаса свежих элементов
+        :param int recent_size: сколько выданных элементов помнить на случай недоступности источника
+        :param float max_delay: максимальная пауза между неудачными попытками в секундах
+        """
+        self.name = name
+        self.size = size
+        self._fetch = fetch
+        self._max_delay = max_delay
+        self._ready: typing.Deque[str] = deque()
+        self._recent: typing.Deque[str] = deque(maxlen=recent_size)
+        self._cond = threading.Condition()
+
+    def start(self):
+        """
+        Запускает фоновое пополнение.
+        """
+        threading.Thread(target=self._refill, name=f"prefetch-{self.name}", daemon=True).start()
+
+    def get(self) -> typing.Tuple[typing.Optional[str], bool]:
+        """
+        Выдает элемент: свежий из запаса, иначе (или если загрузить не удалось) -- один из недавних.
+
+        :return: элемент или ``None`` И ``True``, если элемент свежий
+        :rtype: typing.Tuple[typing.Optional[str], bool]
+        """
+        with self._cond:
+            if self._ready:
+                item = self._ready.popleft()
+                self._recent.append(item)
+                self._cond.notify()
+                return item, True
+        # noinspection PyBroadException
+        try:
+            item = self._fetch()
+        except Exception:
+            log.info(f"{self.name} live fetch failed", exc_info=True)
+            with self._cond:
+                return (random.choice(self._recent), False) if self._recent else (None, False)
+        with self._cond:
+            self._recent.append(item)
+        return item, True
+
+    def __str__(self):
+        return f"{self.name}: {len(self._ready)}/{self.size}"
+
+    def _refill(self):
+        """
+        Пополняет запас, пока он не заполнен; при ошибках ждет все дольше.
+        """
+        delay = 1
+        while True:
+            with self._cond:
+                while len(self._ready) >= self.size:
+                    self._cond.wait()
+            # noinspection PyBroadException
+            try:
+                item = self._fetch()
+            except Exception:
+                log.info(f"{self.name} prefetch failed, retrying in {delay}s", exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, self._max_delay)
+                continue
+            delay = 1
+            with self._cond:
+                self._ready.append(item)
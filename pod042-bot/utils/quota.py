@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик запросов к API с квотой: честная очередь по чатам.
+"""
+import threading
+import time
+import typing
+from collections import OrderedDict, deque
+
+
+def round_robin_position(queues: typing.Mapping[typing.Hashable, typing.Sized], chat_id: typing.Hashable) -> int:
+    """
+    Сколько элементов будет выпущено раньше нового элемента от ``chat_id``,
+    если очереди чатов обходятся по кругу по одному элементу за раз (в порядке ключей ``queues``).
+
+    :param queues: очереди чатов в порядке обхода
+    :param chat_id: ID чата
+    :return: элементов впереди
+    :rtype: int
+    """
+    chats = list(queues)
+    own = len(queues.get(chat_id, ()))
+    index = chats.index(chat_id) if chat_id in queues else len(chats)
+    ahead = own
+    for i, other in enumerate(chats):
+        if other == chat_id:
+            continue
+        ahead += min(len(queues[other]), own + 1 if i < index else own)
+    return ahead
+
+
+class QuotaScheduler:
+    """
+    Следит за остатком квоты и выпускает запросы по очереди, по одному от каждого чата за круг.
+
+    Остаток уточняется по ответам сервера через :meth:`update`; между ними считается локально.
+    """
+
+    quota: int
+    """
+    Кол-во запросов за окно.
+    """
+
+    quota_ttl: float
+    """
+    Длина окна в секундах.
+    """
+
+    def __init__(self, quota: int, quota_ttl: float):
+        """
+        :param int quota: кол-во запросов за окно
+        :param float quota_ttl: длина окна в секундах
+        """
+        self.quota = quota
+        self.quota_ttl = quota_ttl
+        self._remaining: typing.Optional[int] = None  # None -- еще не знаем, считаем что есть
+        self._reset_at = 0.0
+        self._queues: typing.Dict[typing.Hashable, typing.Deque[object]] = OrderedDict()
+        self._cond = threading.Condition()
+
+    def update(self, remaining: int, expire: float):
+        """
+        Принимает остаток квоты из ответа сервера.
+
+        :param int remaining: оставшееся кол-во запросов
+        :param float expire: секунд до обнуления
+        """
+        with self._cond:
+            self._remaining = remaining
+            self._reset_at = time.monotonic() + expire
+            self._cond.notify_all()
+
+    def _available(self, now: float) -> int:
+        if self._remaining is None:
+            return self.quota
+        if now >= self._reset_at:
+            return self.quota
+        return self._remaining
+
+    def _wait_for(self, position: int, now: float) -> float:
+        """
+        Ожидаемое время до выпуска запроса на ``position`` месте. Вызывается под ``_cond``.
+        """
+        available = self._available(now)
+        if position < available:
+            return 0.0
+        windows = (position - available) // max(self.quota, 1)
+        until_reset = self._reset_at - now if now < self._reset_at else self.quota_ttl
+        return until_reset + windows * self.quota_ttl
+
+    def estimate(self, chat_id: typing.Hashable) -> typing.Tuple[int, float]:
+        """
+        Оценивает место в очереди и время ожидания для нового запроса.
+
+        :param chat_id: ID чата
+        :return: (запросов впереди, ожидание в секундах)
+        :rtype: typing.Tuple[int, float]
+        """
+        with self._cond:
+            position = round_robin_position(self._queues, chat_id)
+            return position, self._wait_for(position, time.monotonic())
+
+    def wait_turn(self, chat_id: typing.Hashable, timeout: float,
+                  on_queued: typing.Optional[typing.Callable[[int, float], None]] = None):
+        """
+        Ждет своей очереди и списывает один запрос из квоты.
+
+        :param chat_id: ID чата
+        :param float timeout: максимальное время ожидания в секундах
+        :param on_queued: вызывается с (запросов впереди, ожидание), если сразу выпустить нельзя
+        :raise TimeoutError: очередь не подошла за ``timeout`` секунд
+        """
+        ticket = object()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            position = round_robin_position(self._queues, chat_id)
+            wait = self._wait_for(position, time.monotonic())
+            self._queues.setdefault(chat_id, deque()).append(ticket)
+        try:
+            # Уведомление внутри try: если оно упадет, билет все равно уйдет из очереди
+            if (position > 0 or wait > 0) and on_queued is not None:
+                on_queued(position, wait)
+
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    head_chat = next(iter(self._queues))
+                    if self._queues[head_chat][0] is ticket and self._available(now) > 0:
+                        break
+                    if now >= deadline:
+                        raise TimeoutError(f"quota queue wait exceeded {timeout} s")
+                    next_check = deadline - now
+                    if now < self._reset_at:
+                        next_check = min(next_check, self._reset_at - now)
+                    self._cond.wait(next_check)
+
+                if self._remaining is None or now >= self._reset_at:
+                    self._remaining = self.quota
+                    self._reset_at = now + self.quota_ttl
+                self._remaining -= 1
+        finally:
+            with self._cond:
+                queue = self._queues[chat_id]
+                queue.remove(ticket)
+                del self._queues[chat_id]
+                if queue:
+                    self._queues[chat_id] = queue  # В конец круга
+                self._cond.notify_all()
+
+    @property
+    def queued(self) -> int:
+        """
+        Кол-во запросов в очереди.
+        """
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш результатов поиска картинок.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+try:
+    from .image_hash import BKTree
+except ImportError:
+    from utils.image_hash import BKTree
+
+log = logging.getLogger(__name__)
+
+
+def content_key(data: typing.Union[bytes, bytearray, memoryview]) -> str:
+    """
+    Ключ кэша по содержимому картинки.
+
+    :param data: содержимое картинки
+    :return: ключ вида ``sha256:<hex>``
+    :rtype: str
+    """
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def file_key(file_unique_id: typing.Optional[str]) -> typing.Optional[str]:
+    """
+    Ключ кэша по ``file_unique_id`` из Telegram.
+
+    :param file_unique_id: уникальный ID файла или ``None``
+    :return: ключ вида ``tg:<id>`` или ``None``
+    :rtype: typing.Optional[str]
+    """
+    return None if file_unique_id is None else "tg:" + file_unique_id
+
+
+class ResultCache:
+    """
+    Кэш результатов поиска с TTL и ограничением количества записей (LRU).
+
+    Один и тот же список результатов может храниться под несколькими ключами,
+    например под ``file_unique_id`` и хешем содержимого. Если при сохранении указан
+    перцептивный хеш, запись можно найти и по похожей картинке (``get_similar``).
+    Пустые результаты («ничего не найдено») живут ``empty_ttl`` и по похожим картинкам не находятся.
+    """
+
+    path: str
+    """
+    Путь до ``.pkl``-файла для сохранения кэша.
+    """
+
+    ttl: float
+    """
+    Время жизни записи в секундах.
+    """
+
+    empty_ttl: float
+    """
+    Время жизни пустого результата в секундах.
+    """
+
+    max_entries: int
+    """
+    Максимальное количество записей.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, empty_ttl: float = 0):
+        """
+        :param str path: путь до ``.pkl``-файла
+        :param float ttl: время жизни записи в секундах
+        :param int max_entries: максимальное количество записей
+        :param float empty_ttl: время жизни пустого результата в секундах; 0 -- не сохранять
+        """
+        self.path = path
+        self.ttl = ttl
+        self.empty_ttl = empty_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: typing.Dict[typing.Tuple[str, str], typing.Tuple[float, list]] = OrderedDict()
+        self._phashes: typing.Dict[typing.Tuple[str, str], int] = {}
+        self._trees: typing.Dict[str, BKTree] = {}
+        self._dead_phashes = 0
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, engine: str, *keys: typing.Optional[str]) -> typing.Optional[list]:
+        """
+        Ищет результат по первому подходящему ключу.
+
+        :param str engine: название поискового движка
+        :param keys: ключи; ``None`` пропускаются
+        :return: список результатов или ``None``
+        :rtype: typing.Optional[list]
+        """
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                entry = self._entries.get((engine, key))
+                if entry is None:
+                    continue
+                expires, results = entry
+                if expires < now:
+                    self._evict((engine, key))
+                    continue
+                self._entries.move_to_end((engine, key))
+                self.hits += 1
+                return results
+            self.misses += 1
+        return None
+
+    def get_similar(self, engine: str, phash: int, max_distance: int) -> typing.Optional[list]:
+        """
+        Ищет результат для картинки с близким перцептивным хешем.
+
+        :param str engine: название поискового движка
+        :param int phash: перцептивный хеш картинки
+        :param int max_distance: максимальное расстояние Хэмминга
+        :return: список результатов ближайшей картинки или ``None``
+        :rtype: typing.Optional[list]
+        """
+        now = time.time()
+        with self._lock:
+            tree = self._trees.get(engine)
+            if tree is None:
+                return None
+            for distance, key in tree.find(phash, max_distance):
+                if (engine, key) not in self._phashes:
+                    continue  # Запись уже вытеснена
+                expires, results = self._entries[(engine, key)]
+                if expires < now:
+                    continue
+                self._entries.move_to_end((engine, key))
+                self.similar_hits += 1
+                log.debug(f"{engine} similar hit: {key}, distance {distance}")
+                return results
+        return None
+
+    def put(self, engine: str, results: list, *keys: typing.Optional[str], phash: typing.Optional[int] = None):
+        """
+        Сохраняет результат под всеми указанными ключами.
+
+        :param str engine: название поискового движка
+        :param list results: список результатов
+        :param keys: ключи; ``None`` пропускаются
+        :param phash: перцептивный хеш картинки для ``get_similar``
+        """
+        if not results:
+            if self.empty_ttl <= 0:
+                return
+            phash = None  # «Ничего не найдено» не распространяется на похожие картинки
+        expires = time.time() + (self.ttl if results else self.empty_ttl)
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                self._entries[(engine, key)] = (expires, results)
+                self._entries.move_to_end((engine, key))
+                if phash is not None and (engine, key) not in self._phashes:
+                    self._phashes[(engine, key)] = phash
+                    self._trees.setdefault(engine, BKTree()).add(phash, key)
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+            if self._dead_phashes > len(self._phashes):
+                self._rebuild_trees()
+
+    def _evict(self, full_key: typing.Tuple[str, str]):
+        """
+        Удаляет запись. Вызывается под ``_lock``.
+        """
+        del self._entries[full_key]
+        if self._phashes.pop(full_key, None) is not None:
+            self._dead_phashes += 1
+
+    def _rebuild_trees(self):
+        """
+        Пересобирает BK-деревья без вытесненных записей. Вызывается под ``_lock``.
+        """
+        self._trees = {}
+        for (engine, key), phash in self._phashes.items():
+            self._trees.setdefault(engine, BKTree()).add(phash, key)
+        self._dead_phashes = 0
+
+    def load(self):
+        """
+        Загружает кэш с диска, отбрасывая устаревшие записи.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            saved = pickle.load(file)
+        now = time.time()
+        with self._lock:
+            self._entries = OrderedDict((key, entry) for key, entry in saved["entries"].items() if entry[0] >= now)
+            self._phashes = {key: phash for key, phash in saved["phashes"].items() if key in self._entries}
+            self._rebuild_trees()
+        log.info(f"loaded {len(self._entries)} cached search results")
+
+    def save(self):
+        """
+        Сохраняет кэш на диск.
+        """
+        with self._lock:
+            saved = {
+                "entries": OrderedDict(self._entries),
+                "phashes": dict(self._phashes),
+            }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w+b") as file:
+            pickle.dump(saved, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
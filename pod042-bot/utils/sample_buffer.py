@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Запас заранее сгенерированных ответов нейросети.
+"""
+import collections
+import logging
+import threading
+import time
+import typing
+
+log = logging.getLogger(__name__)
+
+
+class SampleBuffer:
+    """
+    Ограниченный запас сгенерированных текстов для нескольких длин.
+    Фоновый поток пополняет самый пустой запас, но только пока генераторы простаивают.
+    """
+
+    lengths: typing.List[int]
+    """
+    Длины, для которых держится запас.
+    """
+
+    size: int
+    """
+    Максимальный запас для одной длины.
+    """
+
+    hits: int
+    """
+    Количество ответов из запаса.
+    """
+
+    misses: int
+    """
+    Количество запросов подходящей длины, для которых запас был пуст.
+    """
+
+    def __init__(self, produce: typing.Callable[[int], str], lengths: typing.Iterable[int], size: int,
+                 is_idle: typing.Callable[[], bool] = lambda: True, idle_delay: float = 1):
+        """
+        :param produce: генерирует текст указанной длины
+        :param lengths: длины, для которых держится запас
+        :param int size: максимальный запас для одной длины
+        :param is_idle: возвращает ``True``, если генераторы сейчас свободны
+        :param float idle_delay: пауза перед повторной проверкой занятости в секундах
+        """
+        self.lengths = sorted(set(lengths))
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._produce = produce
+        self._is_idle = is_idle
+        self._idle_delay = idle_delay
+        self._samples: typing.Dict[int, typing.Deque[str]] = {length: collections.deque() for length in self.lengths}
+        self._cond = threading.Condition()
+
+    def start(self):
+        """
+        Запускает фоновое пополнение.
+        """
+        threading.Thread(target=self._refill, name="sample-buffer", daemon=True).start()
+
+    def get(self, length: int) -> typing.Optional[str]:
+        """
+        Забирает готовый текст указанной длины.
+
+        :param int length: длина текста
+        :return: текст или ``None``, если запаса нет
+        :rtype: typing.Optional[str]
+        """
+        if length not in self._samples:
+            return None
+        with self._cond:
+            samples = self._samples[length]
+            if not samples:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cond.notify()
+            return samples.popleft()
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Доля запросов, обслуженных из запаса.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        stock = ", ".join(f"{length}: {len(self._samples[length])}/{self.size}" for length in self.lengths)
+        return f"{stock}; попаданий {self.hits}/{self.hits + self.misses} ({self.hit_rate:.0%})"
+
+    def _refill(self):
+        """
+        Пополняет самый пустой запас, пока все не заполнены.
+        """
+        delay = self._idle_delay
+        while True:
+            with self._cond:
+                length = min(self.lengths, key=lambda bucket: len(self._samples[bucket]))
+                while len(self._samples[length]) >= self.size:
+                    self._cond.wait()
+                    length = min(self.lengths, key=lambda bucket: len(self._samples[bucket]))
+            if not self._is_idle():
+                time.sleep(self._idle_delay)  # Пользователи важнее
+                continue
+            # noinspection PyBroadException
+            try:
+                sample = self._produce(length)
+            except Exception:
+                log.warning(f"sample buffer refill failed, retrying in {delay}s", exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+            delay = self._idle_delay
+            with self._cond:
+                self._samples[length].append(sample)
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Пул долгоживущих процессов-генераторов текста (torch-rnn).
+
+Процесс один раз загружает модель, пишет ``READY`` и дальше обслуживает запросы через stdin/stdout:
+
+* запрос: ``<length> <temperature> <N>\\n`` и N байт начального текста (UTF-8);
+* по ходу генерации: сколько угодно ``PART <N>\\n`` и N байт очередного куска текста;
+* ответ: ``OK <N>\\n`` и N байт результата, либо ``ERR <N>\\n`` и N байт описания ошибки.
+"""
+import codecs
+import collections
+import logging
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+import typing
+
+log = logging.getLogger(__name__)
+
+
+class SamplerError(subprocess.SubprocessError):
+    """
+    Процесс-генератор упал, вернул ошибку или нарушил протокол.
+    """
+
+
+class SamplerRequestError(SamplerError):
+    """
+    Процесс-генератор ответил ``ERR`` на запрос, но сам остался рабочим.
+    """
+
+
+class SamplerWorker:
+    """
+    Один процесс-генератор.
+    """
+
+    args: typing.List[str]
+    """
+    Команда запуска процесса.
+    """
+
+    cwd: typing.Optional[str]
+    """
+    Рабочая директория процесса.
+    """
+
+    def __init__(self, args: typing.List[str], cwd: typing.Optional[str] = None):
+        """
+        :param args: команда запуска процесса
+        :param cwd: рабочая директория процесса
+        """
+        self.args = args
+        self.cwd = cwd
+        self._proc: typing.Optional[subprocess.Popen] = None
+        self._buffer = b""
+        self._stderr_tail = collections.deque(maxlen=20)
+
+    def start(self, timeout: float):
+        """
+        Запускает процесс и ждет, пока он загрузит модель.
+
+        :param float timeout: время ожидания ``READY`` в секундах
+        :raise SamplerError: процесс не запустился
+        :raise subprocess.TimeoutExpired: модель грузится дольше ``timeout``
+        """
+        self.kill()
+        self._buffer = b""
+        self._stderr_tail.clear()
+        self._proc = subprocess.Popen(self.args, cwd=self.cwd, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        threading.Thread(target=self._drain_stderr, args=(self._proc,), name="sampler-stderr",
+                         daemon=True).start()
+        line = self._read_line(time.monotonic() + timeout)
+        if line != b"READY":
+            raise self._error(f"unexpected greeting {line!r}")
+        log.info(f"sampler {self._proc.pid} ready")
+
+    def sample(self, length: int, start_text: str, temperature: float, timeout: float,
+               on_partial: typing.Optional[typing.Callable[[str], None]] = None) -> str:
+        """
+        Генерирует текст.
+
+        :param int length: длина результата
+        :param str start_text: начальный текст
+        :param float temperature: температура
+        :param float timeout: время ожидания результата в секундах
+        :param on_partial: вызывается с уже сгенерированной частью текста по мере генерации
+        :return: сгенерированный текст
+        :rtype: str
+        :raise SamplerRequestError: процесс ответил ``ERR``
+        :raise SamplerError: ошибка процесса или протокола
+        :raise subprocess.TimeoutExpired: результат не получен за ``timeout`` секунд;
+                                         уже сгенерированная часть -- в ``output``
+        """
+        deadline = time.monotonic() + timeout
+        start_bytes = start_text.encode("utf-8")
+        try:
+            self._proc.stdin.write(f"{length} {temperature} {len(start_bytes)}\n".encode("ascii") + start_bytes)
+            self._proc.stdin.flush()
+        except (OSError, ValueError) as exc:
+            raise self._error(f"cannot send request: {exc}") from exc
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        partial = ""
+        try:
+            while True:
+                status, _, size = self._read_line(deadline).partition(b" ")
+                if not size.isdigit():
+                    raise self._error(f"malformed response {status + b' ' + size!r}")
+                body = self._read_exact(int(size), deadline)
+                if status == b"PART":
+                    partial += decoder.decode(body)
+                    if on_partial is not None:
+                        # noinspection PyBroadException
+                        try:
+                            on_partial(partial)
+                        except Exception:
+                            log.debug("partial output callback failed", exc_info=True)
+                    continue
+                body = body.decode("utf-8", errors="replace")
+                if status == b"ERR":
+                    raise SamplerRequestError(f"sampler failed: {body}")
+                if status != b"OK":
+                    raise self._error(f"unknown response status {status!r}")
+                return body
+        except subprocess.TimeoutExpired as exc:
+            raise subprocess.TimeoutExpired(self.args, timeout, output=partial or None) from exc
+
+    def kill(self):
+        """
+        Останавливает процесс.
+        """
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        for pipe in (self._proc.stdin, self._proc.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass  # Недописанный запрос в уже мертвый процесс
+        self._proc = None
+
+    def _drain_stderr(self, proc: subprocess.Popen):
+        """
+        Читает stderr процесса, чтобы он не заблокировался, и хранит последние строки для ошибок.
+        """
+        for line in proc.stderr:
+            line = line.decode("utf-8", errors="replace").rstrip()
+            self._stderr_tail.append(line)
+            log.debug(f"sampler {proc.pid}: {line}")
+        proc.stderr.close()
+
+    def _error(self, reason: str) -> SamplerError:
+        """
+        Создает исключение с последними строками stderr процесса.
+        """
+        tail = "\n".join(self._stderr_tail)
+        return SamplerError(f"{reason}\n{tail}" if tail else reason)
+
+    def _fill(self, deadline: float):
+        """
+        Дочитывает очередную порцию stdout в буфер.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(self.args, 0)
+        stdout = self._proc.stdout
+        ready, _, _ = select.select([stdout], [], [], remaining)
+        if not ready:
+            raise subprocess.TimeoutExpired(self.args, remaining)
+        chunk = os.read(stdout.fileno(), 65536)
+        if not chunk:
+            self._proc.wait()
+            raise self._error(f"sampler exited with code {self._proc.returncode}")
+        self._buffer += chunk
+
+    def _read_line(self, deadline: float) -> bytes:
+        """
+        Читает одну строку stdout без перевода строки.
+        """
+        while b"\n" not in self._buffer:
+            self._fill(deadline)
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line
+
+    def _read_exact(self, size: int, deadline: float) -> bytes:
+        """
+        Читает ровно ``size`` байт stdout.
+        """
+        while len(self._buffer) < size:
+            self._fill(deadline)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class SamplerPool:
+    """
+    Пул процессов-генераторов: модель загружается один раз на процесс, а не на каждый запрос.
+    Упавший или зависший процесс убивается и перезапускается в фоне.
+    """
+
+    size: int
+    """
+    Количество процессов.
+    """
+
+    timeout: float
+    """
+    Время ожидания результата (включая ожидание свободного процесса) в секундах.
+    """
+
+    startup_timeout: float
+    """
+    Время ожидания загрузки модели в секундах.
+    """
+
+    restarts: int
+    """
+    Количество перезапусков процессов.
+    """
+
+    def __init__(self, args: typing.List[str], cwd: typing.Optional[str] = None, size: int = 1,
+                 timeout: float = 10, startup_timeout: float = 120):
+        """
+        :param args: команда запуска процесса
+        :param cwd: рабочая директория процессов
+        :param int size: количество процессов
+        :param float timeout: время ожидания результата в секундах
+        :param float startup_timeout: время ожидания загрузки модели в секундах
+        """
+        self.size = size
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.restarts = 0
+        self._workers = [SamplerWorker(args, cwd) for _ in range(size)]
+        self._idle: "queue.Queue[SamplerWorker]" = queue.Queue()
+        self._closed = False
+
+    def start(self):
+        """
+        Запускает все процессы и ждет загрузки моделей.
+
+        :raise SamplerError: процесс не запустился
+        :raise subprocess.TimeoutExpired: модель грузится слишком долго
+        """
+        for worker in self._workers:
+            worker.start(self.startup_timeout)
+            self._idle.put(worker)
+
+    def sample(self, length: int, start_text: str, temperature: float,
+               on_partial: typing.Optional[typing.Callable[[str], None]] = None) -> str:
+        """
+        Генерирует текст на первом свободном процессе.
+
+        :param int length: длина результата
+        :param str start_text: начальный текст
+        :param float temperature: температура
+        :param on_partial: вызывается с уже сгенерированной частью текста по мере генерации
+        :return: сгенерированный текст
+        :rtype: str
+        :raise SamplerRequestError: процесс ответил ``ERR``
+        :raise SamplerError: ошибка процесса
+        :raise subprocess.TimeoutExpired: результат не получен за ``timeout`` секунд;
+                                         уже сгенерированная часть -- в ``output``
+        """
+        deadline = time.monotonic() + self.timeout
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired("sampler pool", self.timeout)
+        try:
+            result = worker.sample(length, start_text, temperature, max(deadline - time.monotonic(), 0),
+                                   on_partial)
+        except SamplerRequestError:
+            self._idle.put(worker)  # Ошибка в запросе, процесс исправен
+            raise
+        except subprocess.SubprocessError:
+            worker.kill()
+            self._restart(worker)
+            raise
+        self._idle.put(worker)
+        return result
+
+    @property
+    def idle(self) -> int:
+        """
+        Количество свободных процессов.
+        """
+        return self._idle.qsize()
+
+    def shutdown(self):
+        """
+        Останавливает все процессы.
+        """
+        self._closed = True
+        for worker in self._workers:
+            worker.kill()
+
+    def _restart(self, worker: SamplerWorker):
+        """
+        Перезапускает процесс в фоне, повторяя попытки с нарастающей паузой.
+        """
+        def revive():
+            delay = 1
+            while not self._closed:
+                try:
+                    worker.start(self.startup_timeout)
+                    self._idle.put(worker)
+                    return
+                except (OSError, subprocess.SubprocessError):
+                    log.warning(f"sampler restart failed, retrying in {delay}s", exc_info=True)
+                    worker.kill()
+                    time.sleep(delay)
+                    delay = min(delay * 2, 60)
+
+        self.restarts += 1
+        threading.Thread(target=revive, name="sampler-restart", daemon=True).start()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Объединение одинаковых одновременных запросов (single-flight).
+"""
+import threading
+import typing
+
+
+class _Call:
+    """
+    Выполняющийся запрос и его результат.
+    """
+
+    done: threading.Event
+    result: typing.Any = None
+    exc: typing.Optional[BaseException] = None
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class SingleFlight:
+    """
+    Гарантирует, что для одного ключа одновременно выполняется только один запрос.
+    Остальные потоки ждут его завершения и получают тот же результат (или исключение).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: typing.Dict[typing.Hashable, _Call] = {}
+
+    def do(self, key: typing.Hashable, func: typing.Callable[[], typing.Any]) -> typing.Any:
+        """
+        Выполняет ``func`` или дожидается уже выполняющегося вызова с тем же ключом.
+
+        :param key: ключ запроса
+        :param func: функция без аргументов, результат которой нужно разделить
+        :return: результат ``func``
+        :raise: исключение, выброшенное ``func``
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.exc is not None:
+                raise call.exc
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as exc:
+            call.exc = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -24,8 +24,9 @@ setup(
         'Pillow',
         'beautifulsoup4',
         'requests[socks]',
-        'psutil'
+        'psutil',
+        'numpy'
     ],
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
 )
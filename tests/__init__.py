@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Тесты и замеры. Модули бота импортируются так же, как при запуске ``python -m pod042-bot``
+из собственной директории пакета.
+"""
+import os
+import sys
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pod042-bot")
+if PACKAGE_PATH not in sys.path:
+    sys.path.insert(0, PACKAGE_PATH)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Замер скорости разбора страниц iqdb.org: старый разбор всей страницы против нового.
+
+    $ python -m tests.bench_iqdb_parser [повторов]
+"""
+import os
+import sys
+import timeit
+
+from tests import FIXTURES_PATH
+from tests import iqdb_legacy
+from external_api import iqdb_org
+
+CASES = [
+    ("search_results.html", iqdb_legacy.parse_search_page, iqdb_org.parse_search_page),
+    ("search_no_match.html", iqdb_legacy.parse_search_page, iqdb_org.parse_search_page),
+    ("status.html", iqdb_legacy.parse_status, iqdb_org.parse_status),
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for name, old_parse, new_parse in CASES:
+        with open(os.path.join(FIXTURES_PATH, "iqdb", name), encoding="utf-8") as fixture:
+            html = fixture.read()
+        old_time = min(timeit.repeat(lambda: old_parse(html), number=number, repeat=3)) / number
+        new_time = min(timeit.repeat(lambda: new_parse(html), number=number, repeat=3)) / number
+        print(f"{name:24} old {old_time * 1000:7.3f} ms  new {new_time * 1000:7.3f} ms  "
+              f"x{old_time / new_time:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Замер подготовки картинки к загрузке на iqdb.org: старый PNG ``optimize=True`` против ``normalize_picture``.
+Процессорное время, размер загрузки и сходство с исходником в масштабе миниатюры.
+
+    $ python -m tests.bench_iqdb_upload [повторов]
+"""
+import sys
+
+from tests import iqdb_legacy
+from tests.image_bench import cpu_time, load_images, report
+from external_api import iqdb_org
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for name, picture in load_images():
+        old_time, old_upload = cpu_time(iqdb_legacy.prepare_upload, picture, number=number)
+        new_time, new_upload = cpu_time(iqdb_org.normalize_picture, picture, iqdb_org.UPLOAD_MAX_SIDE,
+                                        number=number)
+        report(name, "old", old_time, picture, old_upload)
+        report(name, "new", new_time, picture, new_upload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Замер подготовки запроса к trace.moe: старый полноразмерный JPEG в BASE64 против ``build_payload`` в multipart.
+Процессорное время (картинка и тело запроса), размер тела запроса и сходство картинки с исходником.
+
+    $ python -m tests.bench_whatanime_payload [повторов]
+"""
+import sys
+
+import requests
+
+from tests import whatanime_legacy
+from tests.image_bench import cpu_time, load_images, report
+from external_api import whatanime_ga
+
+
+def old_request(picture: bytes):
+    image = whatanime_legacy.encode_image(picture)
+    return image, whatanime_legacy.request_body(image)
+
+
+def new_request(picture: bytes):
+    image = whatanime_ga.build_payload(picture)
+    return image, requests.Request("POST", "{}/api/search".format(whatanime_ga.ENDPOINT), files={
+        "image": ("image.jpg", image, "image/jpeg"),
+    }).prepare().body
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for name, picture in load_images():
+        try:
+            old_time, (old_image, old_body) = cpu_time(old_request, picture, number=number)
+            report(name, "old", old_time, picture, old_image, len(old_body))
+        except OSError:  # Старый путь не умел сохранять в JPEG прозрачность и палитру
+            report(name, "old", 0, picture, None)
+        new_time, (new_image, new_body) = cpu_time(new_request, picture, number=number)
+        report(name, "new", new_time, picture, new_image, len(new_body))
+
+
+if __name__ == '__main__':
+    main()
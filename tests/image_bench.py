@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Общее для замеров подготовки картинок: фикстуры, процессорное время и качество результата.
+"""
+import math
+import os
+import time
+import typing
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageStat
+
+from tests import FIXTURES_PATH
+from utils import image_hash, image_pool
+
+IMAGES_PATH = os.path.join(FIXTURES_PATH, "images")
+THUMB_SIDE = 150  # Примерно в таком размере поисковики сравнивают картинки
+
+
+def load_images() -> typing.List[typing.Tuple[str, bytes]]:
+    """
+    Читает картинки-фикстуры.
+
+    :return: (имя файла, содержимое) по алфавиту
+    :rtype: typing.List[typing.Tuple[str, bytes]]
+    """
+    images = []
+    for name in sorted(os.listdir(IMAGES_PATH)):
+        with open(os.path.join(IMAGES_PATH, name), "rb") as image_file:
+            images.append((name, image_file.read()))
+    return images
+
+
+def cpu_time(func: typing.Callable, *args, number: int = 5) -> typing.Tuple[float, typing.Any]:
+    """
+    Лучшее процессорное время одного вызова из ``number``.
+
+    :return: секунды И результат последнего вызова
+    :rtype: typing.Tuple[float, typing.Any]
+    """
+    best, result = math.inf, None
+    for _ in range(number):
+        started = time.process_time()
+        result = func(*args)
+        best = min(best, time.process_time() - started)
+    return best, result
+
+
+def thumbnail(data: bytes) -> Image.Image:
+    return image_pool.to_rgb(Image.open(BytesIO(data))).convert("RGB").resize((THUMB_SIDE, THUMB_SIDE),
+                                                                              Image.LANCZOS)
+
+
+def quality(original: bytes, uploaded: bytes) -> typing.Tuple[int, float]:
+    """
+    Насколько загружаемая картинка похожа на исходную в масштабе миниатюры.
+
+    :return: расстояние dHash И PSNR миниатюр в дБ
+    :rtype: typing.Tuple[int, float]
+    """
+    distance = image_hash.hamming(image_hash.dhash_bytes(original), image_hash.dhash_bytes(uploaded))
+    diff = ImageStat.Stat(ImageChops.difference(thumbnail(original), thumbnail(uploaded)))
+    mse = sum(rms ** 2 for rms in diff.rms) / len(diff.rms)
+    psnr = math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+    return distance, psnr
+
+
+def report(name: str, label: str, seconds: float, original: bytes, uploaded: typing.Optional[bytes],
+           sent: typing.Optional[int] = None):
+    """
+    Печатает строку замера: время, размер и качество результата.
+
+    :param sent: сколько байт уходит по сети, если это не сама картинка (например, тело запроса)
+    """
+    if uploaded is None:
+        print(f"{name:26} {label:4} не поддерживается")
+        return
+    distance, psnr = quality(original, uploaded)
+    size = len(uploaded) if sent is None else sent
+    print(f"{name:26} {label:4} cpu {seconds * 1000:8.1f} ms  {size / 1024:8.1f} KB  "
+          f"dhash {distance:2}  psnr {psnr:5.1f} dB")
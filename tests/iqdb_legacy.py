@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Работа с iqdb.org в том виде, в каком она была до оптимизаций: разбор страниц целиком
+(до ``parse_search_page``/``parse_status``) и загрузка картинки в PNG (до ``normalize_picture``).
+Эталон для сравнения результатов и скорости.
+"""
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from PIL import Image
+from bs4 import BeautifulSoup, Tag
+
+from external_api.iqdb_org import ENDPOINT, FAIL_COUNT_REGEX, FAIL_REASON_REGEX, MAX_SIZE, IqdbBooru, \
+    IqdbResult, MatchTypeEnum
+
+
+def parse_status(html: str) -> List[IqdbBooru]:
+    """
+    Разбирает страницу статуса бур, как ``IqdbClient.get_status``.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    table_body: Tag = soup.find("table", attrs={
+        "style": "white-space: nowrap"
+    }).find("tbody")
+
+    result = []
+    for entry in table_body.find_all('tr'):
+        entry_strings = entry.find_all('td')
+        r_name = entry_strings[0].text
+        r_post_update = entry_strings[1].text
+        r_tag_update = entry_strings[2].text
+        r_latest_post = int(entry_strings[3].text)
+        update_failure_string: str = entry_strings[4].text
+        r_update_fail_count = None
+        r_update_fail_reason = None
+        if len(update_failure_string) > 0:
+            # noinspection PyBroadException
+            try:
+                r_update_fail_count = int(
+                    FAIL_COUNT_REGEX.search(update_failure_string).group(1)
+                )
+                r_update_fail_reason = FAIL_REASON_REGEX.search(update_failure_string) \
+                    .group(1).replace('\n', '')
+            except:
+                pass
+        result.append(IqdbBooru(
+            name=r_name,
+            post_update=r_post_update,
+            tag_update=r_tag_update,
+            latest_post=r_latest_post,
+            update_fail_count=r_update_fail_count,
+            update_fail_reason=r_update_fail_reason
+        ))
+    return result
+
+
+def parse_search_page(html: str) -> Tuple[Optional[str], List[IqdbResult]]:
+    """
+    Разбирает страницу с результатами поиска, как ``IqdbClient.search``.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+
+    results_timing = soup.find("p", attrs={
+        "style": "font-size: small;",
+    }).text
+
+    result: List[IqdbResult] = []
+
+    results_boxes: Tag = soup.find("div", attrs={
+        "id": "pages",
+        "class": "pages",
+    })
+
+    for result_box in results_boxes.find_all('div'):  # Main matches
+        info_strings: List[Tag] = result_box.find('table') \
+            .find_all('tr')
+        match_type = info_strings[0].find('th').text
+        if match_type == MatchTypeEnum.SKIP.value:
+            continue  # Your image
+        if match_type == MatchTypeEnum.NO.value:
+            continue  # No relevant matches
+        r_match_type = match_type
+        links: Tag = info_strings[1].find('td')
+        source_link: str = links.find('a')['href']
+        r_source_link = 'http:' + source_link if source_link.startswith('//') else source_link
+        img_tag: Tag = links.find('a').find('img')
+        r_preview_link = ENDPOINT + img_tag['src']
+        r_tags = None
+        if img_tag.has_attr('title'):
+            if ',' in img_tag['title']:
+                split_char = ','
+            else:
+                split_char = ' '
+            # noinspection PyBroadException
+            try:
+                r_tags = img_tag['title'].split('Tags: ')[1].split(split_char)
+            except:
+                pass
+        res_and_rating = info_strings[3].find('td').text
+        r_resolution, r_rating = res_and_rating.split(' ')
+        r_similarity = info_strings[4].find('td').text.split('%')[0]
+
+        result.append(IqdbResult(
+            match_type=r_match_type,
+            preview_link=r_preview_link,
+            source_link=r_source_link,
+            resolution=r_resolution,
+            rating=r_rating,
+            similarity=r_similarity,
+            tags=r_tags
+        ))
+
+    return results_timing, result
+
+
+def prepare_upload(picture: bytes) -> bytes:
+    """
+    Готовит картинку к загрузке, как ``IqdbClient.search`` до ``normalize_picture``:
+    любая картинка пережимается в PNG с ``optimize=True``.
+    """
+    img: Image.Image = Image.open(BytesIO(picture))
+    if img.height >= 7500 or img.width >= 7500:
+        raise RuntimeError("image height or width is larger than 7500px")
+    out = BytesIO()
+    img.save(out, "PNG", optimize=True)
+    if out.getbuffer().nbytes > MAX_SIZE:
+        raise RuntimeError("image is larger than 8MB")
+    return out.getvalue()
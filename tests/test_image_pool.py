@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Ошибки из процессов пула картинок должны доходить до вызывающего, не ломая пул.
+"""
+import pickle
+import unittest
+
+from tests import PACKAGE_PATH  # noqa: F401 (путь до модулей бота)
+from external_api import iqdb_org
+from utils import image_pool
+
+
+class ImagePoolTest(unittest.TestCase):
+
+    def test_not_a_picture_pickles(self):
+        error = pickle.loads(pickle.dumps(image_pool.NotAPictureError()))
+        self.assertIsInstance(error, image_pool.NotAPictureError)
+        self.assertEqual(str(error), "file is not a picture")
+
+    def test_not_a_picture_from_pool(self):
+        pool = image_pool.ImagePool(1, 4, 30, preload=[iqdb_org.__name__])
+        try:
+            with self.assertRaises(image_pool.NotAPictureError):
+                pool.run(iqdb_org.normalize_picture, b"notapic", 800)
+            with self.assertRaises(image_pool.NotAPictureError):
+                pool.run(iqdb_org.normalize_picture, b"notapic", 800)
+            self.assertEqual(pool.pending, 0)
+        finally:
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
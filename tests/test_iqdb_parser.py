@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Новый разбор страниц iqdb.org должен давать тот же результат, что и старый, на записанных страницах.
+"""
+import os
+import unittest
+
+from tests import FIXTURES_PATH
+from tests import iqdb_legacy
+from external_api import iqdb_org
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES_PATH, "iqdb", name), encoding="utf-8") as fixture:
+        return fixture.read()
+
+
+class IqdbParserTest(unittest.TestCase):
+
+    def assert_same_search(self, name: str):
+        html = read_fixture(name)
+        old_timing, old_results = iqdb_legacy.parse_search_page(html)
+        new_timing, new_results = iqdb_org.parse_search_page(html)
+        self.assertEqual(old_timing, new_timing)
+        self.assertEqual([vars(result) for result in old_results], [vars(result) for result in new_results])
+        return new_timing, new_results
+
+    def test_search_results(self):
+        timing, results = self.assert_same_search("search_results.html")
+        self.assertEqual(timing, "Searched 14,379,355 images in 3.528 seconds.")
+        self.assertEqual([result.match_type for result in results], ["Best match", "Additional match",
+                                                                     "Possible match"])
+        self.assertEqual(results[0].source_link, "http://danbooru.donmai.us/posts/2980531")
+        self.assertIsNone(results[0].tags)
+        self.assertEqual(results[1].similarity, "91")
+
+    def test_search_no_match(self):
+        timing, results = self.assert_same_search("search_no_match.html")
+        self.assertEqual(timing, "Searched 14,379,402 images in 2.917 seconds.")
+        self.assertEqual(results, [])
+
+    def test_status(self):
+        html = read_fixture("status.html")
+        old_status = iqdb_legacy.parse_status(html)
+        new_status = iqdb_org.parse_status(html)
+        self.assertEqual([vars(booru) for booru in old_status], [vars(booru) for booru in new_status])
+        self.assertEqual(len(new_status), 8)
+        self.assertEqual((new_status[2].update_fail_count, new_status[2].update_fail_reason),
+                         (3, "HTTP request failed:503 Service Unavailable"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Запрос поиска к trace.moe в том виде, в каком он был до ``build_payload``:
+полноразмерный JPEG в BASE64 внутри urlencoded-формы. Эталон для сравнения размера и скорости.
+"""
+import base64
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+from external_api.whatanime_ga import ENDPOINT
+
+
+def encode_image(picture: bytes) -> bytes:
+    """
+    Пережимает картинку в JPEG без уменьшения, как ``WhatAnimeClient.search``.
+    """
+    img: Image.Image = Image.open(BytesIO(picture))
+    out = BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def request_body(image: bytes) -> bytes:
+    """
+    Тело запроса поиска с картинкой в BASE64.
+    """
+    base64_encoded_image: str = str(base64.b64encode(image), "utf-8")
+    return requests.Request("POST", "{}/api/search".format(ENDPOINT), headers={
+        "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
+    }, data={
+        "image": "\'data:image/jpeg;base64," + base64_encoded_image + "\'",
+    }).prepare().body.encode("ascii")